@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+#
+# Fruit2pi key latency benchmark
+# Replays synthetic evdev key frames through the Keyboard pipeline and the
+# server's BTKbDevice.send_string, with local socketpairs standing in for
+# the report socket and the L2CAP interrupt channel. No bluetooth adapter,
+# input device or dbus service is needed.
+#
+import os
+import sys
+import random
+import socket
+import time
+from optparse import OptionParser, make_option
+from evdev import InputEvent, ecodes
+import kb_client
+import keymap
+
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import btk_server
+from transport import PipeTransport
+
+
+# a Keyboard that writes reports to sock instead of a real device/server
+def make_keyboard(sock, mode):
+    return kb_client.Keyboard.detached(sock, mode)
+
+
+# a BTKbDevice on an in-memory transport, returns it and the host's end of
+# the interrupt channel
+def make_device():
+    transport = PipeTransport()
+    dev = btk_server.BTKbDevice(0, transport)
+    dev.listen()
+    return dev, transport.host[1]
+
+
+# random typing as evdev would read it, a list of SYN_REPORT frames: mostly
+# single keys, some shifted, with shift and the key in the same frame half
+# of the time
+def make_frames(count, seed):
+    rnd = random.Random(seed)
+    keys = [code for code in range(keymap.KEY_MAX + 1)
+            if keymap.hid_usage[code] and not keymap.modifier_mask[code]]
+    shift = ecodes.KEY_LEFTSHIFT
+
+    def key(code, value):
+        return InputEvent(0, 0, ecodes.EV_KEY, code, value)
+
+    def frame(*events):
+        return list(events) + [InputEvent(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+
+    frames = []
+    for _ in range(count):
+        code = rnd.choice(keys)
+        shifted = rnd.random() < 0.2
+        if shifted and rnd.random() < 0.5:
+            frames.append(frame(key(shift, 1), key(code, 1)))
+            frames.append(frame(key(code, 0), key(shift, 0)))
+            continue
+        if shifted:
+            frames.append(frame(key(shift, 1)))
+        frames.append(frame(key(code, 1)))
+        frames.append(frame(key(code, 0)))
+        if shifted:
+            frames.append(frame(key(shift, 0)))
+    return frames
+
+
+def drain(sock):
+    out = []
+    while True:
+        try:
+            out.append(sock.recv(64))
+        except BlockingIOError:
+            return out
+
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))]
+
+
+def run(name, frames, mode):
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    dev, sink = make_device()
+    server.setblocking(False)
+    sink.setblocking(False)
+    kb = make_keyboard(client, mode)
+    # activate without set_program, which would change current_program
+    with open(os.path.join(kb_client.programs_dir, name)) as f:
+        res = kb_client.activate_program(name, f.read())
+    if 'error' in res:
+        return None
+    latencies = []
+    reports = 0
+    start = time.perf_counter()
+    for frame in frames:
+        t0 = time.perf_counter()
+        kb.do_events(kb_client.Keyboard.FEED, frame)
+        # what BTKbService.on_report does for each datagram
+        for data in drain(server):
+            dev.send_string(data)
+        reports += len(drain(sink))
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    dev.disconnect()
+    for s in (client, server, sink):
+        s.close()
+    latencies.sort()
+    return {
+        'events': sum(len(frame) - 1 for frame in frames),
+        'reports': reports,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1],
+        'frames': len(frames),
+        'frames_per_s': len(frames) / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="bench.py [options] [program ...]", option_list=[
+        make_option("-n", "--keys", dest="keys", type="int", default=2000,
+                    help="number of keystrokes to replay"),
+        make_option("-s", "--seed", dest="seed", type="int", default=0),
+        make_option("-k", "--keyboard", dest="keyboard", default="6kro",
+                    type="choice", choices=["6kro", "nkro"]),
+        make_option("--max-p99", dest="max_p99", type="float", default=None,
+                    help="exit with 1 if any program's p99 is above this many us"),
+    ])
+    (options, args) = parser.parse_args()
+    names = args or sorted(os.listdir(kb_client.programs_dir))
+    frames = make_frames(options.keys, options.seed)
+
+    failed = False
+    print("%-20s %8s %8s %8s %10s %10s %10s %12s" %
+          ("program", "events", "frames", "reports", "p50 us", "p99 us", "max us", "frames/s"))
+    for name in names:
+        r = run(name, frames, options.keyboard)
+        if r is None:
+            print("%-20s failed to load" % name)
+            failed = True
+            continue
+        print("%-20s %8d %8d %8d %10.1f %10.1f %10.1f %12.0f" %
+              (name, r['events'], r['frames'], r['reports'], r['p50'] * 1e6,
+               r['p99'] * 1e6, r['max'] * 1e6, r['frames_per_s']))
+        if options.max_p99 is not None and r['p99'] * 1e6 > options.max_p99:
+            failed = True
+    sys.exit(1 if failed else 0)
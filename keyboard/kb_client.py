@@ -9,23 +9,117 @@ import sys  # used to exit the script
 import dbus
 import dbus.service
 import dbus.mainloop.glib
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
 import time
 import evdev  # used to get input from the keyboard
+import pyudev  # used to see input devices come and go
 from evdev import *
 import keymap  # used to map evdev input to hid keodes
+from report import make_report, Report, ConsumerReport, SystemReport
 import selectors
 from cbor._cbor import dumps, loads
 import socket
+import hashlib
+from optparse import OptionParser, make_option
+import logging
+from logging import debug
+
+# realtime.py is shared with btk_server
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import realtime
+from stats import Stats
+from collections import deque
+
+logging.basicConfig(level=logging.INFO)
+
+# checked before logging in the hot path, see set_log_level
+DEBUG = False
+
+def set_log_level(level):
+    global DEBUG
+    logging.getLogger().setLevel(level)
+    DEBUG = logging.getLogger().isEnabledFor(logging.DEBUG)
 
 programs_dir = os.path.join(sys.path[0], 'programs')
 
+# btk_server's local report socket, see server/btk_server.py
+REPORT_SOCKET = "/run/fruit2pi/report.sock"
+
+# compiled programs, keyed by (name, sha1 of source), so a key event only
+# runs prebuilt bytecode instead of compiling the program every time
+program_cache = {}
+
+def compile_program(name, program):
+    key = (name, hashlib.sha1(program.encode('utf-8')).hexdigest())
+    code = program_cache.get(key)
+    if code is None:
+        code = compile(program, name, 'exec')
+        # drop stale versions of the same program
+        for k in [k for k in program_cache if k[0] == name]:
+            del program_cache[k]
+        program_cache[key] = code
+    return code
+
+# entry points a program can define instead of top level statements:
+#   on_load()              called once when the program is set
+#   on_key(event, state)   called for every key press and release
+#   on_press(event, state) called for key presses only
+#   on_release(event, state) called for key releases only
+# event is the evdev event, state the report after applying the event.
+# Programs defining none of these are run top level per key as before,
+# with the report bound to `event`.
+PROGRAM_HANDLERS = ('on_load', 'on_key', 'on_press', 'on_release')
+
+def make_program(name, program):
+    code = compile_program(name, program)
+    prog = {'name': name, 'program': program, 'code': code, 'legacy': True}
+    for h in PROGRAM_HANDLERS:
+        prog[h] = None
+    if set(PROGRAM_HANDLERS).intersection(code.co_names):
+        # run the top level once, the namespace lives as long as the
+        # program is set so handlers can keep counters and layers in it
+        namespace = {'__name__': name, '__builtins__': __builtins__,
+                     'fruit2pi': fruit2pi, 'keymap': keymap, 'ecodes': ecodes}
+        exec(code, namespace)
+        for h in PROGRAM_HANDLERS:
+            prog[h] = namespace.get(h)
+        prog['namespace'] = namespace
+        prog['legacy'] = False
+    return prog
+
+def activate_program(name, program):
+    global current_program
+    try:
+        prog = make_program(name, program)
+    except SyntaxError as e:
+        return {'error': 'syntax', 'message': str(e)}
+    except Exception as e:
+        return {'error': 'load', 'message': repr(e)}
+    if prog['on_load']:
+        try:
+            prog['on_load']()
+        except Exception as e:
+            return {'error': 'load', 'message': repr(e)}
+    # swap in the new program in one assignment
+    current_program = prog
+    return {'status': 'success'}
+
 def list_programs():
     global current_program
     return {'programs': os.listdir(programs_dir), 'current_program': current_program['name']}
 
 def edit_program(name, code):
+    try:
+        compile_program(name, code)
+    except SyntaxError as e:
+        return {'error': 'syntax', 'message': str(e)}
     with open(os.path.join(programs_dir, name), 'w') as f:
         f.write(code)
+    if current_program and current_program['name'] == name:
+        res = activate_program(name, code)
+        if 'error' in res:
+            return res
     return {'status': 'success'}
 
 def delete_programs(names):
@@ -33,6 +127,8 @@ def delete_programs(names):
         f = os.path.join(programs_dir, name)
         if os.path.exists(f):
             os.remove(f)
+        for k in [k for k in program_cache if k[0] == name]:
+            del program_cache[k]
     return {'status': 'success'}
 
 def load_program(name):
@@ -41,10 +137,11 @@ def load_program(name):
     return {'program': program}
 
 def set_program(name):
-    global current_program
     with open(os.path.join(programs_dir, name)) as f:
         program = f.read()
-        current_program = {'name': name, 'program': program}
+    res = activate_program(name, program)
+    if 'error' in res:
+        return res
     with open(os.path.join(sys.path[0], 'current_program'), 'w') as f:
         f.write(name)
     return {'status': 'success', 'current_program': name}
@@ -76,6 +173,14 @@ def process_command(data):
             return {'error': 'format'}
         name = args[0]
         return set_program(name)
+    elif cmd == 'log':
+        if len(args) != 1 or type(args[0]) != str:
+            return {'error': 'format'}
+        level = logging.getLevelName(args[0].upper())
+        if not isinstance(level, int):
+            return {'error': 'format'}
+        set_log_level(level)
+        return {'status': 'success'}
     elif cmd == 'load':
         if len(args) != 1:
             return {'error': 'format'}
@@ -85,105 +190,482 @@ def process_command(data):
         return {'error': 'format'}
 
 
+# mouse button codes -> bit in the mouse report, rel axes -> x, y, wheel
+MOUSE_BUTTONS = {
+    ecodes.BTN_LEFT: 0x01,
+    ecodes.BTN_RIGHT: 0x02,
+    ecodes.BTN_MIDDLE: 0x04,
+    ecodes.BTN_SIDE: 0x08,
+    ecodes.BTN_EXTRA: 0x10,
+}
+MOUSE_AXES = {
+    ecodes.REL_X: 0,
+    ecodes.REL_Y: 1,
+    ecodes.REL_WHEEL: 2,
+}
+
+# 'keyboard' if the device has keys we can send (including the System
+# Control node of a keyboard with only power, sleep and wake up),
+# 'mouse' for relative pointers, None for anything else
+def device_kind(caps):
+    keys = caps.get(ecodes.EV_KEY, [])
+    for code in keys:
+        if code < ecodes.BTN_MISC and (keymap.hid_usage[code] or
+                                       keymap.consumer_usage[code] or
+                                       keymap.system_usage[code]):
+            return 'keyboard'
+    if ecodes.REL_X in caps.get(ecodes.EV_REL, []):
+        return 'mouse'
+    return None
+
+
 fruit2pi = None
 current_program = None
 
 
 # Define a client to listen to local key events
 class Keyboard():
+    # reports sent over dbus without a reply yet, sending blocks above this
+    MAX_IN_FLIGHT = 8
+    # seconds before an unanswered report call counts as failed
+    DBUS_TIMEOUT = 1.0
+    # seconds between sending latency histograms to btk_server
+    STATS_INTERVAL = 5.0
+    # the fd do_events takes for events fed by hand to a detached Keyboard
+    FEED = -1
 
-    def __init__(self):
+    def __init__(self, report_socket=None, mice=False, grab=False, repeat=False):
+        print("setting up DBus Client")
+
+        # report calls are async, replies are handled by pumping the glib
+        # context from the selector loop
+        self.ctx = GLib.MainContext.default()
+        self.config_dbus()
+        # the bt keyboard report family is what btk_server told the host
+        self.init_state(self.keyboard_mode(), mice, grab, repeat)
+        # reports go straight to btk_server over a unix socket when enabled
+        self.report_socket = report_socket
+        if report_socket:
+            self.config_direct()
+        global fruit2pi
+        fruit2pi = self
+        # programs are loaded once fruit2pi is set, on_load may already send
         name = None
         with open(os.path.join(sys.path[0], 'current_program')) as f:
             try:
                 name = f.read()
             except:
                 name = 'default'
-        set_program(name)
-        
-        # the structure for a bt keyboard input report (size is 10 bytes)
-        self.state = [
-            0xA1,  # this is an input report
-            0x01,  # Usage report = Keyboard
-            # Bit array for Modifier keys
-            [0,  # Right GUI - Windows Key
-             0,  # Right ALT
-             0,  # Right Shift
-             0,  # Right Control
-             0,  # Left GUI
-             0,  # Left ALT
-             0,  # Left Shift
-             0],  # Left Control
-            0x00,  # Vendor reserved
-            0x00,  # rest is space for 6 keys
-            0x00,
-            0x00,
-            0x00,
-            0x00,
-            0x00]
-
-        print("setting up DBus Client")
-
-        self.config_dbus()
-        global fruit2pi
-        fruit2pi = self
-        print("waiting for keyboard")
-        # keep trying to key a keyboard
-        have_dev = False
+        if 'error' in set_program(name):
+            print("program %s failed to load, using default" % name)
+            set_program('default')
         self.scommand = socket.socket(
             socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
         self.scommand.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.scommand.bind((socket.BDADDR_ANY, 21))
         self.scommand.listen(5)
         self.scommand.setblocking(False)
-        while have_dev == False:
+        self.sel = selectors.DefaultSelector()
+        # udev tells us about devices plugged in or out from now on
+        self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        self.monitor.filter_by('input')
+        self.monitor.start()
+        self.sel.register(self.monitor.fileno(), selectors.EVENT_READ, self.do_udev)
+        self.find_devices()
+        if not self.devs:
+            print("waiting for keyboard")
+
+    # A Keyboard that writes every report to sock (e.g. one end of a
+    # socketpair, see bench.py), with no dbus, input devices, command socket
+    # or program loaded. Feed it events with do_events(Keyboard.FEED, ...).
+    @classmethod
+    def detached(cls, sock, mode='6kro', mice=False):
+        kb = cls.__new__(cls)
+        kb.init_state(mode, mice)
+        kb.direct = sock
+        kb.dev_keys[Keyboard.FEED] = set()
+        global fruit2pi
+        fruit2pi = kb
+        return kb
+
+    # the reports and the key, mouse, frame and repeat bookkeeping
+    def init_state(self, mode, mice=False, grab=False, repeat=False):
+        self.in_flight = 0
+        self.dbus_error = None
+        self.init_stats()
+        # report id -> the last report sent with it
+        self.last_sent = {}
+        # the bt keyboard input report, 6 key slots or an nkro bitmap
+        self.state = make_report(mode)
+        self.consumer = ConsumerReport()
+        self.system = SystemReport()
+        self.direct = None
+        self.report_socket = None
+        # input devices by fd, all feeding the same reports. A key held on
+        # two devices stays down until released on both.
+        self.mice = mice
+        self.devs = {}
+        # fd -> codes held on that device, released if it goes away
+        self.dev_keys = {}
+        self.key_down = bytearray(keymap.KEY_MAX + 1)
+        self.mouse_buttons = 0
+        self.mouse_motion = [0, 0, 0]
+        self.mouse_dirty = False
+        # report -> (event seq, report bytes, force) sent during the current
+        # frame
+        self.in_frame = False
+        self.frame = {}
+        self.event_seq = 0
+        self.grab = grab
+        # realtime.IdleCollector when the cyclic gc is off, polled from the
+        # event loop with the time of the last input event
+        self.collector = None
+        self.last_event = 0.0
+        # key code -> (delay, interval) in ms for btk_server to repeat it
+        # with, None to leave repeating to the host. 0 is btk_server's
+        # default.
+        self.repeat_keys = {}
+        self.repeat_default = (0, 0) if repeat else None
+        # the last key pressed in the current frame
+        self.repeat_code = None
+        # the key btk_server was asked to repeat, and whether it was
+        # released since
+        self.repeating = None
+        self.repeat_released = False
+
+    # open every keyboard (and with mice set, mouse) evdev device not
+    # already in use
+    def find_devices(self):
+        paths = set(dev.path for dev in self.devs.values())
+        for path in evdev.list_devices():
+            if path in paths:
+                continue
             try:
-                # try and get a keyboard - should always be event0 as
-                # we're only plugging one thing in
-                self.dev = InputDevice("/dev/input/event0")
-                have_dev = True
+                dev = InputDevice(path)
+                kind = device_kind(dev.capabilities())
             except OSError:
-                print("Keyboard not found, waiting 3 seconds and retrying")
-                time.sleep(3)
-            print("found a keyboard")
-    
+                continue
+            if kind == 'keyboard' or (kind == 'mouse' and self.mice):
+                self.add_device(dev)
+            else:
+                dev.close()
+
+    def add_device(self, dev):
+        print("found %s: %s" % (dev.path, dev.name))
+        if self.grab:
+            # keep the key events from the local console
+            try:
+                dev.grab()
+            except OSError as e:
+                print('could not grab %s: %s' % (dev.path, e), file=sys.stderr)
+        self.devs[dev.fd] = dev
+        self.dev_keys[dev.fd] = set()
+        self.sel.register(dev.fd, selectors.EVENT_READ, self.do_dev_ev)
+
+    # forget a device, releasing whatever was held on it
+    def remove_device(self, fd):
+        dev = self.devs.pop(fd, None)
+        if dev is None:
+            return
+        print("lost %s" % dev.path)
+        self.sel.unregister(fd)
+        try:
+            dev.close()
+        except OSError:
+            pass
+        now = time.time()
+        for code in list(self.dev_keys[fd]):
+            self.key_event(fd, evdev.InputEvent(int(now), int(now % 1 * 1000000),
+                                                ecodes.EV_KEY, code, 0))
+        del self.dev_keys[fd]
+        # nothing held anywhere, make sure the host sees everything up
+        # whatever the program did with the releases
+        if not any(self.key_down):
+            for report in (self.state, self.consumer, self.system):
+                report.clear()
+                # only reports the host has seen, and that are not all up
+                # already
+                last = self.last_sent.get(report.REPORT_ID)
+                if last is not None and last != report.buf:
+                    self.send(report)
+            if self.mouse_buttons:
+                self.mouse_buttons = 0
+                self.send_mouse(0, 0, 0, 0)
+        self.update_repeat()
+
+    def do_udev(self, fd, mask):
+        while True:
+            device = self.monitor.poll(timeout=0)
+            if device is None:
+                return
+            node = device.device_node
+            if not node or not device.sys_name.startswith('event'):
+                continue
+            if device.action == 'add':
+                self.find_devices()
+            elif device.action == 'remove':
+                for dev_fd, dev in list(self.devs.items()):
+                    if dev.path == node:
+                        self.remove_device(dev_fd)
+
+    # per stage latency histograms, btk_server's get_stats returns them
+    # along with its own
+    def init_stats(self):
+        self.stats = Stats()
+        # kernel event timestamp to reading it
+        self.evdev_time = self.stats.histogram('client.evdev')
+        # running the program for one key
+        self.program_time = self.stats.histogram('client.program')
+        # reading the events to having sent all their reports
+        self.frame_time = self.stats.histogram('client.frame')
+        # dbus call to its reply
+        self.dbus_time = self.stats.histogram('client.dbus')
+        # start times of the calls in flight, replies come back in order
+        self.call_times = deque()
+        self.stats_sent = time.monotonic()
+        self.stats_dirty = False
+
+    def send_stats(self):
+        self.stats_sent = time.monotonic()
+        self.stats_dirty = False
+        self.send_dbus(self.iface.put_stats,
+                       dbus.Dictionary(self.stats.snapshot(), signature='sau'))
+
     def config_dbus(self):
-        self.bus = dbus.SystemBus()
+        self.bus = dbus.SystemBus(mainloop=DBusGMainLoop())
         self.btkservice = self.bus.get_object(
             'org.fruit2pi.btkbservice', '/org/fruit2pi/btkbservice')
         self.iface = dbus.Interface(self.btkservice, 'org.fruit2pi.btkbservice')
 
+    # replies to calls made before a dbus reconfig may still come in after
+    # in_flight was reset, so never go below zero
+    def on_send_reply(self, *args):
+        if self.in_flight > 0:
+            self.in_flight -= 1
+        if self.call_times:
+            self.dbus_time.since(self.call_times.popleft())
+
+    def on_send_error(self, e):
+        self.on_send_reply()
+        # a report the host was not told about (btk_server run with an older
+        # --sdp-record) is dropped, like with the direct socket
+        if e.get_dbus_name() == 'org.fruit2pi.btkbservice.UnsupportedReport':
+            if DEBUG:
+                debug('report dropped: %s', e)
+            return
+        # no host connected is not a problem with our dbus connection
+        if e.get_dbus_name() == 'org.fruit2pi.btkbservice.NotConnected':
+            if DEBUG:
+                debug('report dropped, host not connected')
+            # the host has not seen it, don't hold back the next one
+            self.last_sent.clear()
+            return
+        self.dbus_error = e
+
+    # handle the replies that have arrived, without blocking
+    def pump_dbus(self):
+        while self.ctx.pending():
+            self.ctx.iteration(False)
+        if self.dbus_error is not None:
+            e = self.dbus_error
+            self.dbus_error = None
+            raise e
+
+    def keyboard_mode(self):
+        try:
+            return str(self.iface.get_keyboard_mode())
+        except dbus.DBusException:
+            return '6kro'
+
+    def config_direct(self):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sock.connect(self.report_socket)
+            self.direct = sock
+            print("sending reports through " + self.report_socket)
+        except OSError as e:
+            print('direct report socket unavailable, using dbus:', e, file=sys.stderr)
+            self.direct = None
+
     def change_state(self, event):
-        evdev_code = ecodes.KEY[event.code]
-        modkey_element = keymap.modkey(evdev_code)
+        code = event.code
+        if code > keymap.KEY_MAX:
+            return self.state
+        mask = keymap.modifier_mask[code]
+        if mask:
+            self.state.set_modifier(mask, event.value == 1)
+            return self.state
+        # Get the keycode of the key, media and power keys go to their own
+        # reports
+        report = self.state
+        hex_key = keymap.hid_usage[code]
+        if hex_key == 0:
+            hex_key = keymap.consumer_usage[code]
+            report = self.consumer
+        if hex_key == 0:
+            hex_key = keymap.system_usage[code]
+            report = self.system
+        if hex_key == 0:
+            return self.state
+        if event.value == 1:
+            report.press(hex_key)
+        elif event.value == 0:
+            report.release(hex_key)
+        return report
 
-        if modkey_element > 0:
-            if self.state[2][modkey_element] == 0:
-                self.state[2][modkey_element] = 1
-            else:
-                self.state[2][modkey_element] = 0
-        else:
-            # Get the keycode of the key
-            hex_key = keymap.convert(ecodes.KEY[event.code])
-            # Loop through elements 4 to 9 of the inport report structure
-            for i in range(4, 10):
-                if self.state[i] == hex_key and event.value == 0:
-                    # Code 0 so we need to depress it
-                    self.state[i] = 0x00
-                elif self.state[i] == 0x00 and event.value == 1:
-                    # if the current space if empty and the key is being pressed
-                    self.state[i] = hex_key
-                    break
-        return self.state
+    # apply a key event to the report and run the current program on it
+    def handle_event(self, event):
+        t0 = time.monotonic()
+        self.event_seq += 1
+        prog = current_program
+        if prog['legacy']:
+            event = self.change_state(event)
+            eval(prog['code'])
+            self.program_time.since(t0)
+            return
+        state = self.change_state(event)
+        if event.value == 1:
+            if prog['on_press']:
+                prog['on_press'](event, state)
+        elif prog['on_release']:
+            prog['on_release'](event, state)
+        if prog['on_key']:
+            prog['on_key'](event, state)
+        self.program_time.since(t0)
 
     # poll for keyboard events
+    # events are handled a SYN_REPORT frame at a time, reports the program
+    # sends during a frame go out once when the frame ends
+    def do_dev_ev(self, fd, mask):
+        try:
+            events = list(self.devs[fd].read())
+        except OSError:
+            self.remove_device(fd)
+            return
+        self.do_events(fd, events)
+
+    # handle the events of one read from a device
+    def do_events(self, fd, events):
+        t0 = self.last_event = time.monotonic()
+        if events:
+            # evdev timestamps are wall clock time
+            self.evdev_time.add(time.time() - events[0].timestamp(), t0)
+        self.stats_dirty = True
+        self.in_frame = True
+        try:
+            self.do_frames(fd, events)
+        finally:
+            self.in_frame = False
+            self.flush_frame()
+            self.update_repeat()
+            self.frame_time.since(t0)
+
+    def do_frames(self, fd, events):
+        for event in events:
+            if event.type == ecodes.EV_KEY:
+                bit = MOUSE_BUTTONS.get(event.code)
+                if bit is not None:
+                    if self.mice and event.value < 2:
+                        if event.value:
+                            self.mouse_buttons |= bit
+                        else:
+                            self.mouse_buttons &= ~bit
+                        self.mouse_dirty = True
+                elif event.value < 2:
+                    self.key_event(fd, event)
+            elif event.type == ecodes.EV_REL and self.mice:
+                axis = MOUSE_AXES.get(event.code)
+                if axis is not None:
+                    self.mouse_motion[axis] += event.value
+                    self.mouse_dirty = True
+            elif event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT:
+                self.flush_frame()
+                if self.mouse_dirty:
+                    self.mouse_dirty = False
+                    dx, dy, wheel = self.mouse_motion
+                    self.mouse_motion[:] = (0, 0, 0)
+                    self.send_mouse(self.mouse_buttons, dx, dy, wheel)
+
+    def flush_frame(self):
+        if self.frame:
+            frame = list(self.frame.values())
+            self.frame.clear()
+            for seq, data, force in frame:
+                self.send_raw(data, force)
+
+    # only the first press and the last release of a key held on several
+    # devices reach the program
+    def key_event(self, fd, event):
+        code = event.code
+        held = self.dev_keys[fd]
+        n = self.key_down[code]
+        if event.value == 1:
+            if code in held:
+                return
+            held.add(code)
+            self.key_down[code] = n + 1
+            if n:
+                return
+            self.repeat_code = code
+        else:
+            if code not in held:
+                return
+            held.discard(code)
+            self.key_down[code] = n - 1
+            if n > 1:
+                return
+            if code == self.repeating:
+                self.repeat_released = True
+        self.handle_event(event)
+
+    # let btk_server repeat a key (and for programs, configure how): after
+    # delay ms and then every interval ms. delay None turns it off for
+    # the key.
+    def set_repeat(self, code, delay=0, interval=0):
+        if delay is None:
+            self.repeat_keys[code] = None
+        else:
+            self.repeat_keys[code] = (delay, interval)
+
+    # once a frame's reports are sent: stop the repeat of a released key,
+    # whatever the program sent for it, then start one for a new key
+    def update_repeat(self):
+        if self.repeat_released:
+            self.repeat_released = False
+            self.repeating = None
+            self.send_dbus(self.iface.stop_repeat)
+        if self.repeat_code is not None:
+            code = self.repeat_code
+            self.repeat_code = None
+            self.start_repeat(code)
+
+    # ask btk_server to repeat the report just sent for a pressed key. Only
+    # keys the program actually sent are repeated, and the server drops the
+    # request if the next report got there first.
+    def start_repeat(self, code):
+        delay_interval = self.repeat_keys.get(code, self.repeat_default)
+        if delay_interval is None or code > keymap.KEY_MAX or keymap.modifier_mask[code]:
+            return
+        report = self.state
+        usage = keymap.hid_usage[code]
+        if usage == 0:
+            report = self.consumer
+            usage = keymap.consumer_usage[code]
+        if usage == 0:
+            return
+        last = self.last_sent.get(report.REPORT_ID)
+        if last is None or last != report.buf:
+            return
+        down = bytes(report.buf)
+        if not report.release(usage):
+            return
+        up = bytes(report.buf)
+        report.press(usage)
+        self.send_dbus(self.iface.repeat_report, down, up, *delay_interval)
+        self.repeating = code
+
     def event_loop(self):
-        sel = selectors.DefaultSelector()
-        def do_kbd_ev(fd, mask):
-            for event in self.dev.read():
-                if event.type == ecodes.EV_KEY and event.value < 2:
-                    event = self.change_state(event)
-                    eval(compile(current_program['program'], current_program['name'], 'exec'))
+        sel = self.sel
         def do_cmd(conn, mask):
             data = conn.recv(65535)  # Should be ready
             if data:
@@ -199,39 +681,151 @@ class Keyboard():
             print (
                 "\033[0;32mGot a connection on the command port from %s \033[0m" % cinfo[0])
             sel.register(self.ccommand, selectors.EVENT_READ, do_cmd)
-        sel.register(self.dev.fd, selectors.EVENT_READ, do_kbd_ev)
         sel.register(self.scommand, selectors.EVENT_READ, do_cmd_conn)
         global current_program
         while True:
             try:
-                events = sel.select()
+                # wake up regularly while replies are outstanding
+                timeout = 0.005 if self.in_flight else None
+                if self.collector:
+                    wait = self.collector.poll(self.last_event)
+                    timeout = wait if timeout is None else min(timeout, wait)
+                if self.stats_dirty:
+                    wait = max(0, self.stats_sent + Keyboard.STATS_INTERVAL - time.monotonic())
+                    if wait == 0:
+                        self.send_stats()
+                    else:
+                        timeout = wait if timeout is None else min(timeout, wait)
+                events = sel.select(timeout)
                 for key, mask in events:
                     callback = key.data
                     callback(key.fileobj, mask)
+                self.pump_dbus()
             except dbus.DBusException as e:
                 print('A dbus error occurred:', file=sys.stderr)
                 print(e.__repr__(), file=sys.stderr)
                 print('reconfig dbus', file=sys.stderr)
+                self.in_flight = 0
+                self.call_times.clear()
+                # calls may have been lost, send the next reports again
+                self.last_sent.clear()
                 self.config_dbus()
+                if self.report_socket and not self.direct:
+                    self.config_direct()
             except BaseException as e:
                 print('An error occurred:', file=sys.stderr)
                 print(e.__repr__(), file=sys.stderr)
                 print(e, file=sys.stderr)
 
-    # forward keyboard events to the dbus service
-    def send(self, event):
-        bin_str = ""
-        state = event
-        print(*state)
-        element = state[2]
-        for bit in element:
-            bin_str += str(bit)
-        self.iface.send_key(int(bin_str, 2), self.state[4:10])
+    # send a report to btk_server (over the direct socket if there is one,
+    # else dbus), the keyboard report unless the program passes the one
+    # change_state returned for a media or power key
+    # Inside a frame the report is only noted, a later event of the same
+    # frame sending it again replaces it and moves it behind the others, so
+    # reports go out in the order of their events. Sends from one event are
+    # all kept so macros still work.
+    # A report equal to the last one sent with its id is dropped, force
+    # sends it anyway.
+    def send(self, event=None, force=False):
+        state = event if isinstance(event, Report) else self.state
+        if not self.in_frame:
+            self.send_raw(state.view, force)
+            return
+        pending = self.frame.pop(state, None)
+        if pending is not None and pending[0] == self.event_seq:
+            # the reports noted before this one go first
+            self.frame[state] = pending
+            self.flush_frame()
+            force = force or pending[2]
+        self.frame[state] = (self.event_seq, bytes(state.buf), force)
+
+    def send_raw(self, data, force=False):
+        last = self.last_sent.get(data[1])
+        if last is None:
+            self.last_sent[data[1]] = bytearray(data)
+        elif last == data and not force:
+            return
+        else:
+            last[:] = data
+        if DEBUG:
+            debug('report %s', bytes(data).hex())
+        if self.direct:
+            try:
+                self.direct.send(data)
+                return
+            except OSError as e:
+                print('direct report socket failed, using dbus:', e, file=sys.stderr)
+                self.direct.close()
+                self.direct = None
+        self.send_dbus(self.iface.send_report, bytes(data))
+
+    # relative mouse motion, btk_server coalesces it before sending
+    def send_mouse(self, buttons, dx, dy, wheel):
+        if self.direct:
+            try:
+                # a mouse report only holds -127..127, split bigger moves
+                while True:
+                    x = max(-127, min(127, dx))
+                    y = max(-127, min(127, dy))
+                    w = max(-127, min(127, wheel))
+                    self.direct.send(bytes((0xA1, 2, buttons, x & 0xFF, y & 0xFF, w & 0xFF)))
+                    dx -= x
+                    dy -= y
+                    wheel -= w
+                    if not (dx or dy or wheel):
+                        return
+            except OSError as e:
+                print('direct report socket failed, using dbus:', e, file=sys.stderr)
+                self.direct.close()
+                self.direct = None
+        clamp = lambda v: max(-32767, min(32767, v))
+        self.send_dbus(self.iface.send_mouse_motion, buttons,
+                       clamp(dx), clamp(dy), clamp(wheel))
+
+    # hand a whole macro to the server in one call, reports are complete
+    # reports (e.g. bytes(fruit2pi.state.buf)), delays in ms, see
+    # BTKbService.send_reports
+    def send_reports(self, reports, delays=()):
+        self.send_dbus(self.iface.send_reports, [bytes(r) for r in reports],
+                       dbus.Array(delays, signature='u'))
+
+    # calls are sent without waiting for the reply, the bus keeps them in
+    # order. Past MAX_IN_FLIGHT unanswered calls wait for the server.
+    def send_dbus(self, method, *args):
+        while self.in_flight >= Keyboard.MAX_IN_FLIGHT:
+            self.ctx.iteration(True)
+        self.in_flight += 1
+        self.call_times.append(time.monotonic())
+        method(*args, reply_handler=self.on_send_reply,
+               error_handler=self.on_send_error,
+               timeout=Keyboard.DBUS_TIMEOUT)
 
 
 if __name__ == "__main__":
+    parser = OptionParser(option_list=[
+        make_option("-d", "--direct", dest="direct", action="store_true",
+                    default=False,
+                    help="send reports over btk_server's unix socket instead of dbus"),
+        make_option("-r", "--report-socket", dest="report_socket",
+                    default=REPORT_SOCKET),
+        make_option("-m", "--mouse", dest="mouse", action="store_true",
+                    default=False, help="also forward mice"),
+        make_option("-g", "--grab", dest="grab", action="store_true",
+                    default=False, help="grab input devices for exclusive use"),
+        make_option("-R", "--repeat", dest="repeat", action="store_true",
+                    default=False,
+                    help="have btk_server repeat held keys instead of the host"),
+        make_option("-v", "--debug", dest="debug", action="store_true",
+                    default=False, help="log every report"),
+    ] + realtime.OPTIONS)
+    (options, args) = parser.parse_args()
+    if options.debug:
+        set_log_level(logging.DEBUG)
+
     print("Setting up keyboard")
-    kb = Keyboard()
+    kb = Keyboard(options.report_socket if options.direct else None, options.mouse,
+                  options.grab, options.repeat)
+    kb.collector = realtime.apply(options)
 
     print("starting event loop")
     kb.event_loop()
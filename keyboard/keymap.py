@@ -8,6 +8,9 @@
 # Ported to a Python module by Thanh Le
 #
 
+from array import array
+from evdev import ecodes
+
 keytable = {
     "KEY_RESERVED" : 0,
     "KEY_ESC" : 41,
@@ -184,6 +187,82 @@ modkeys = {
     "KEY_LEFTCTRL": 7
 }
 
+# Media, browser and application keys sent as consumer control usages
+# (HID usage page 0x0C) instead of keyboard usages
+consumertable = {
+    "KEY_MUTE" : 0xE2,
+    "KEY_VOLUMEUP" : 0xE9,
+    "KEY_VOLUMEDOWN" : 0xEA,
+    "KEY_PLAYPAUSE" : 0xCD,
+    "KEY_PLAY" : 0xB0,
+    "KEY_PAUSECD" : 0xB1,
+    "KEY_RECORD" : 0xB2,
+    "KEY_FASTFORWARD" : 0xB3,
+    "KEY_REWIND" : 0xB4,
+    "KEY_NEXTSONG" : 0xB5,
+    "KEY_PREVIOUSSONG" : 0xB6,
+    "KEY_STOPCD" : 0xB7,
+    "KEY_EJECTCD" : 0xB8,
+    "KEY_BRIGHTNESSUP" : 0x6F,
+    "KEY_BRIGHTNESSDOWN" : 0x70,
+    "KEY_MEDIA" : 0x183,
+    "KEY_MAIL" : 0x18A,
+    "KEY_CALC" : 0x192,
+    "KEY_WWW" : 0x196,
+    "KEY_SEARCH" : 0x221,
+    "KEY_HOMEPAGE" : 0x223,
+    "KEY_BACK" : 0x224,
+    "KEY_FORWARD" : 0x225,
+    "KEY_STOP" : 0x226,
+    "KEY_REFRESH" : 0x227,
+    "KEY_BOOKMARKS" : 0x22A,
+}
+
+# Power keys sent as system control, the value is the report's array index
+# (1 Power Down, 2 Sleep, 3 Wake Up)
+systemtable = {
+    "KEY_POWER" : 1,
+    "KEY_SLEEP" : 2,
+    "KEY_WAKEUP" : 3,
+}
+
+# Highest evdev key code, see linux/input-event-codes.h
+KEY_MAX = 0x2ff
+
+# Flat tables indexed by the numeric evdev key code, built once at import so
+# the event loop needs no name lookups. Unmapped codes give 0.
+#   hid_usage[code]     -> HID usage id of the key
+#   modifier_mask[code] -> bit of the key in the report's modifier byte
+#   consumer_usage[code] -> consumer control usage
+#   system_usage[code]  -> system control value
+# A key is only in one of hid_usage, consumer_usage and system_usage.
+hid_usage = bytearray(KEY_MAX + 1)
+modifier_mask = bytearray(KEY_MAX + 1)
+consumer_usage = array('H', bytes(2 * (KEY_MAX + 1)))
+system_usage = bytearray(KEY_MAX + 1)
+
+def _build_tables():
+    for name, usage in consumertable.items():
+        code = ecodes.ecodes.get(name)
+        if code is not None and code <= KEY_MAX:
+            consumer_usage[code] = usage
+    for name, value in systemtable.items():
+        code = ecodes.ecodes.get(name)
+        if code is not None and code <= KEY_MAX:
+            system_usage[code] = value
+    for name, usage in keytable.items():
+        code = ecodes.ecodes.get(name)
+        if code is not None and code <= KEY_MAX and \
+                not consumer_usage[code] and not system_usage[code]:
+            hid_usage[code] = usage
+    for name, element in modkeys.items():
+        code = ecodes.ecodes.get(name)
+        if code is not None and code <= KEY_MAX:
+            # element 0 (Right GUI) is the most significant bit
+            modifier_mask[code] = 1 << (7 - element)
+
+_build_tables()
+
 def convert(evdev_keycode):
     return keytable[evdev_keycode]
 
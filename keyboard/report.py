@@ -0,0 +1,180 @@
+#
+# Fruit2pi keyboard input reports
+# Bt keyboard reports kept in a fixed bytearray, so building and sending a
+# report does not allocate. KeyboardReport is the 6 key rollover boot style
+# report, NkroKeyboardReport has one bit per key. btk_server decides which
+# one the host was told about (BTKbService.get_keyboard_mode).
+# ConsumerReport and SystemReport carry media and power keys separately so
+# the keyboard report stays small.
+#
+
+
+class Report():
+    SIZE = 2
+    REPORT_ID = 0
+
+    def __init__(self):
+        self.buf = bytearray(self.SIZE)
+        self.buf[0] = 0xA1  # this is an input report
+        self.buf[1] = self.REPORT_ID
+        self.view = memoryview(self.buf)
+
+    def clear(self):
+        self.buf[2:] = bytes(self.SIZE - 2)
+
+    def __getitem__(self, i):
+        return self.buf[i]
+
+    def __len__(self):
+        return self.SIZE
+
+    def __repr__(self):
+        return ' '.join(str(b) for b in self.buf)
+
+
+class BaseKeyboardReport(Report):
+    SIZE = 3
+    REPORT_ID = 0x01  # Usage report = Keyboard
+    # buf[2] is the modifier byte
+
+    @property
+    def modifiers(self):
+        return self.buf[2]
+
+    @modifiers.setter
+    def modifiers(self, mask):
+        self.buf[2] = mask
+
+    def set_modifier(self, mask, down):
+        old = self.buf[2]
+        if down:
+            self.buf[2] = old | mask
+        else:
+            self.buf[2] = old & ~mask
+        return self.buf[2] != old
+
+
+class KeyboardReport(BaseKeyboardReport):
+    SIZE = 10
+    # key slots are bytes 4 to 9 of the report, buf[3] is vendor reserved
+    FIRST_SLOT = 4
+    SLOTS = 6
+
+    def __init__(self):
+        BaseKeyboardReport.__init__(self)
+        self.keys = self.view[KeyboardReport.FIRST_SLOT:]
+        # pressed usage -> its slot in buf, plus the free slots
+        self.slots = {}
+        self.free = list(range(KeyboardReport.SIZE - 1, KeyboardReport.FIRST_SLOT - 1, -1))
+
+    # put a key in a free slot, returns False if it was already down or
+    # all slots are in use
+    def press(self, usage):
+        if usage in self.slots or not self.free:
+            return False
+        i = self.free.pop()
+        self.buf[i] = usage
+        self.slots[usage] = i
+        return True
+
+    # free the slot of a key, returns False if it was not down
+    def release(self, usage):
+        i = self.slots.pop(usage, None)
+        if i is None:
+            return False
+        self.buf[i] = 0
+        self.free.append(i)
+        return True
+
+    def clear(self):
+        BaseKeyboardReport.clear(self)
+        self.slots.clear()
+        self.free[:] = range(KeyboardReport.SIZE - 1, KeyboardReport.FIRST_SLOT - 1, -1)
+
+
+class NkroKeyboardReport(BaseKeyboardReport):
+    # one bit for each usage 0 to 0xFF from byte 4 on (modifiers go in the
+    # modifier byte instead), buf[3] is vendor reserved as in the 6kro report
+    USAGES = 0x100
+    FIRST_BYTE = 4
+    SIZE = FIRST_BYTE + USAGES // 8
+
+    def __init__(self):
+        BaseKeyboardReport.__init__(self)
+        self.keys = self.view[NkroKeyboardReport.FIRST_BYTE:]
+
+    # set the key's bit, returns False if it was already set or the usage
+    # has no bit
+    def press(self, usage):
+        if usage == 0 or usage >= NkroKeyboardReport.USAGES:
+            return False
+        i = NkroKeyboardReport.FIRST_BYTE + (usage >> 3)
+        bit = 1 << (usage & 7)
+        if self.buf[i] & bit:
+            return False
+        self.buf[i] |= bit
+        return True
+
+    # clear the key's bit, returns False if it was not set
+    def release(self, usage):
+        if usage == 0 or usage >= NkroKeyboardReport.USAGES:
+            return False
+        i = NkroKeyboardReport.FIRST_BYTE + (usage >> 3)
+        bit = 1 << (usage & 7)
+        if not self.buf[i] & bit:
+            return False
+        self.buf[i] &= ~bit
+        return True
+
+
+# one consumer control usage (volume, media, browser keys) at a time,
+# little endian in bytes 2 and 3
+class ConsumerReport(Report):
+    SIZE = 4
+    REPORT_ID = 0x03
+
+    def press(self, usage):
+        if self.usage == usage:
+            return False
+        self.buf[2] = usage & 0xFF
+        self.buf[3] = usage >> 8
+        return True
+
+    def release(self, usage):
+        if self.usage != usage:
+            return False
+        self.buf[2] = 0
+        self.buf[3] = 0
+        return True
+
+    @property
+    def usage(self):
+        return self.buf[2] | self.buf[3] << 8
+
+
+# one system control key (power down, sleep, wake up) as 1 to 3
+class SystemReport(Report):
+    SIZE = 3
+    REPORT_ID = 0x04
+
+    def press(self, value):
+        if self.buf[2] == value:
+            return False
+        self.buf[2] = value
+        return True
+
+    def release(self, value):
+        if self.buf[2] != value:
+            return False
+        self.buf[2] = 0
+        return True
+
+
+REPORTS = {
+    '6kro': KeyboardReport,
+    'nkro': NkroKeyboardReport,
+}
+
+
+def make_report(mode):
+    return REPORTS[mode]()
@@ -4,9 +4,9 @@ import sys  # used to exit the script
 import dbus
 import dbus.service
 import dbus.mainloop.glib
-import time
 # import thread
 import keymap
+from report import make_report
 
 
 class BtkStringClient():
@@ -15,26 +15,6 @@ class BtkStringClient():
     KEY_DELAY = 0.01
 
     def __init__(self):
-        # the structure for a bt keyboard input report (size is 10 bytes)
-        self.state = [
-            0xA1,  # this is an input report
-            0x01,  # Usage report = Keyboard
-            # Bit array for Modifier keys
-            [0,  # Right GUI - Windows Key
-                 0,  # Right ALT
-                 0,  # Right Shift
-                 0,  # Right Control
-                 0,  # Left GUI
-                 0,  # Left ALT
-                 0,  # Left Shift
-                 0],  # Left Control
-            0x00,  # Vendor reserved
-            0x00,  # rest is space for 6 keys
-            0x00,
-            0x00,
-            0x00,
-            0x00,
-            0x00]
         self.scancodes = {" ": "KEY_SPACE"}
         # connect with the Bluetooth keyboard server
         print("setting up DBus Client")
@@ -42,38 +22,45 @@ class BtkStringClient():
         self.btkservice = self.bus.get_object(
             'org.fruit2pi.btkbservice', '/org/fruit2pi/btkbservice')
         self.iface = dbus.Interface(self.btkservice, 'org.fruit2pi.btkbservice')
+        # the bt keyboard input report in the server's format
+        self.state = make_report(str(self.iface.get_keyboard_mode()))
 
     def send_key_state(self):
         """sends a single frame of the current key state to the emulator server"""
-        bin_str = ""
-        element = self.state[2]
-        for bit in element:
-            bin_str += str(bit)
-        self.iface.send_keys(int(bin_str, 2), self.state[4:10])
+        self.iface.send_report(bytes(self.state.buf))
 
     def send_key_down(self, scancode):
         """sends a key down event to the server"""
-        self.state[4] = scancode
+        self.state.press(scancode)
         self.send_key_state()
 
-    def send_key_up(self):
+    def send_key_up(self, scancode):
         """sends a key up event to the server"""
-        self.state[4] = 0
+        self.state.release(scancode)
         self.send_key_state()
 
+    def scancode(self, c):
+        cu = c.upper()
+        if(cu in self.scancodes):
+            scantablekey = self.scancodes[cu]
+        else:
+            scantablekey = "KEY_"+c.upper()
+        print(scantablekey)
+        return keymap.keytable[scantablekey]
+
     def send_string(self, string_to_send):
+        """sends the whole string as one batch, the server does the timing"""
+        reports = []
+        delays = []
         for c in string_to_send:
-            cu = c.upper()
-            if(cu in self.scancodes):
-                scantablekey = self.scancodes[cu]
-            else:
-                scantablekey = "KEY_"+c.upper()
-            print(scantablekey)
-            scancode = keymap.keytable[scantablekey]
-            self.send_key_down(scancode)
-            time.sleep(BtkStringClient.KEY_DOWN_TIME)
-            self.send_key_up()
-            time.sleep(BtkStringClient.KEY_DELAY)
+            scancode = self.scancode(c)
+            self.state.press(scancode)
+            reports.append(bytes(self.state.buf))
+            delays.append(int(BtkStringClient.KEY_DOWN_TIME * 1000))
+            self.state.release(scancode)
+            reports.append(bytes(self.state.buf))
+            delays.append(int(BtkStringClient.KEY_DELAY * 1000))
+        self.iface.send_reports(reports, delays)
 
 
 if __name__ == "__main__":
@@ -13,13 +13,50 @@ import dbus.service
 import dbus.mainloop.glib
 import time
 import socket
+from collections import deque
 from gi.repository import GLib
 from dbus.mainloop.glib import DBusGMainLoop
 import logging
 from logging import debug, info, warning, error
+from transport import L2capTransport, make_transport
+import hid
+import realtime
+from stats import Stats
+from xml.etree import ElementTree
 
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+# the hot path checks this flag instead of calling into logging, so with
+# debug off no report is ever formatted
+DEBUG = False
+
+def set_log_level(level):
+    global DEBUG
+    logging.getLogger().setLevel(level)
+    DEBUG = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+# returned to dbus clients sending while no host is connected
+class NotConnectedError(dbus.DBusException):
+    _dbus_error_name = 'org.fruit2pi.btkbservice.NotConnected'
+
+
+# returned for reports the sdp record's descriptor does not declare (e.g. a
+# --sdp-record without consumer control), the host would not understand them
+class UnsupportedReportError(dbus.DBusException):
+    _dbus_error_name = 'org.fruit2pi.btkbservice.UnsupportedReport'
+
+
+# l2cap peers are (bdaddr, psm), unix socket peers usually have no name
+def peer_name(cinfo):
+    if isinstance(cinfo, tuple):
+        return cinfo[0]
+    return cinfo or "local socket"
+
+
+def signed_byte(b):
+    return b - 256 if b > 127 else b
+
 
 class BTKbDevice():
     # change these constants
@@ -29,26 +66,91 @@ class BTKbDevice():
     P_CTRL = 17  # Service port - must match port configured in SDP record
     P_INTR = 19  # Service port - must match port configured in SDP record#Interrrupt port
     # dbus path of the bluez profile we will create
-    # file path of the sdp record to load
-    SDP_RECORD_PATH = sys.path[0] + "/sdp_record.xml"
+    # file path of an sdp record to load instead of the one built in hid.py
+    SDP_RECORD_PATH = None
+    # keyboard report family announced to the host, see hid.KEYBOARD_MODES
+    KEYBOARD_MODE = '6kro'
     UUID = "00001124-0000-1000-8000-00805f9b34fb"
+    ADAPTER_PATH = "/org/bluez/hci0"
+    # peripheral, keyboard/pointing combo; bluez adds the service class bits
+    DEVICE_CLASS = 0x0025C0
+    # reports held while the host link is down, 0 to drop them instead
+    QUEUE_SIZE = 64
+    # queued reports older than this (seconds) are only kept if they are
+    # the last state of their report id
+    QUEUE_MAX_AGE = 2.0
+    # report ids whose reports carry absolute state, repeating the same
+    # report twice is a no-op for these (mouse reports carry motion)
+    STATE_REPORT_IDS = (hid.KEYBOARD_REPORT_ID, hid.CONSUMER_REPORT_ID,
+                        hid.SYSTEM_REPORT_ID)
 
-    def __init__(self):
+    def __init__(self, queue_size=QUEUE_SIZE, transport=None):
         print("2. Setting up BT device")
-        self.init_bt_device()
-        self.init_bluez_profile()
+        # (time, report) ring buffer, oldest reports fall off when full
+        self.pending = deque(maxlen=queue_size) if queue_size else None
+        # report id -> latest queued (time, report) of each STATE_REPORT_IDS
+        # id, kept even once the ring dropped it so the final state (e.g.
+        # the last key release) always reaches the host
+        self.last_state = {}
+        self.transport = transport or L2capTransport(self.P_CTRL, self.P_INTR)
+        self.ccontrol = None
+        self.cinterrupt = None
+        # monotonic time of the last report, gc waits for a quiet moment
+        self.last_send = 0.0
+        # how long the interrupt channel send takes and how long reports
+        # waited in the disconnected queue
+        self.stats = Stats()
+        self.send_time = self.stats.histogram('server.send')
+        self.queue_time = self.stats.histogram('server.queued')
+        # fd of a connected channel -> its glib watch
+        self.watches = {}
+        # report id -> payload size, for the reports the host is told about
+        try:
+            self.report_lengths = hid.load_sdp_record(
+                BTKbDevice.SDP_RECORD_PATH, BTKbDevice.KEYBOARD_MODE)[1]
+        except (OSError, ValueError, ElementTree.ParseError) as e:
+            sys.exit("Could not load the sdp record (%s). Exiting..." % e)
+        # one report buffer per report id, the dbus methods fill them in
+        # place and send them without building a new report each time
+        self.reports = {}
+        for report_id, length in self.report_lengths.items():
+            buf = bytearray(2 + length)
+            buf[0] = 0xA1
+            buf[1] = report_id
+            self.reports[report_id] = buf
+        if self.transport.needs_adapter:
+            self.init_bt_device()
+            self.init_bluez_profile()
         global fruit2pi
         fruit2pi = self
 
-    # configure the bluetooth hardware device
+    # configure the bluetooth hardware device through bluez's Adapter1
+    # properties instead of forking hciconfig for each setting
     def init_bt_device(self):
         print("3. Configuring Device name " + BTKbDevice.MY_DEV_NAME)
-        # set the device class to a keybord and set the name
-        os.system("hciconfig hci0 up")
-        os.system("hciconfig hci0 class 0x0025C0")
-        os.system("hciconfig hci0 name " + BTKbDevice.MY_DEV_NAME)
-        # make the device discoverable
-        os.system("hciconfig hci0 piscan")
+        bus = dbus.SystemBus()
+        adapter = dbus.Interface(bus.get_object("org.bluez", BTKbDevice.ADAPTER_PATH),
+                                 "org.freedesktop.DBus.Properties")
+        # powered has to come first, the rest needs a running adapter
+        settings = [
+            ("Powered", dbus.Boolean(True)),
+            ("Alias", dbus.String(BTKbDevice.MY_DEV_NAME)),
+            ("DiscoverableTimeout", dbus.UInt32(0)),
+            ("Discoverable", dbus.Boolean(True)),
+            ("Pairable", dbus.Boolean(True)),
+        ]
+        for name, value in settings:
+            adapter.Set("org.bluez.Adapter1", name, value)
+        props = adapter.GetAll("org.bluez.Adapter1")
+        for name, value in settings:
+            if props.get(name) != value:
+                warning("adapter %s is %s, wanted %s", name, props.get(name), value)
+        # Class is read only in Adapter1 (bluez takes it from main.conf), so
+        # only fall back to hciconfig when it is not a keyboard already
+        if int(props.get("Class", 0)) & 0x1fff != BTKbDevice.DEVICE_CLASS & 0x1fff:
+            warning("adapter class is 0x%06x, setting it with hciconfig",
+                    int(props.get("Class", 0)))
+            os.system("hciconfig hci0 class 0x%06X" % BTKbDevice.DEVICE_CLASS)
 
     # set up a bluez profile to advertise device capabilities from a loaded service record
     def init_bluez_profile(self):
@@ -66,104 +168,593 @@ class BTKbDevice():
         manager.RegisterProfile("/org/bluez/hci0", BTKbDevice.UUID, opts)
         print("6. Profile registered ")
 
-    # read and return an sdp record from a file
+    # return the sdp record, built from the descriptor in hid.py unless
+    # SDP_RECORD_PATH points to a file
     def read_sdp_service_record(self):
         print("5. Reading service record")
         try:
-            fh = open(BTKbDevice.SDP_RECORD_PATH, "r")
-        except:
-            sys.exit("Could not open the sdp record. Exiting...")
-        return fh.read()
+            return hid.sdp_record(BTKbDevice.SDP_RECORD_PATH, BTKbDevice.KEYBOARD_MODE)
+        except (OSError, ValueError, ElementTree.ParseError) as e:
+            sys.exit("Could not load the sdp record (%s). Exiting..." % e)
 
     # listen for incoming client connections
     def listen(self):
         print("\033[0;33m7. Waiting for connections\033[0m")
-        self.scontrol = socket.socket(
-            socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)  # BluetoothSocket(L2CAP)
-        self.sinterrupt = socket.socket(
-            socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)  # BluetoothSocket(L2CAP)
-        self.scontrol.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sinterrupt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # bind these sockets to a port - port zero to select next available
-        self.scontrol.bind((socket.BDADDR_ANY, self.P_CTRL))
-        self.sinterrupt.bind((socket.BDADDR_ANY, self.P_INTR))
-
-        # Start listening on the server sockets
-        self.scontrol.listen(5)
-        self.sinterrupt.listen(5)
-        self.accept_conn()
-
-    def accept_conn(self):
-        self.ccontrol, cinfo = self.scontrol.accept()
+        listeners = self.transport.listen()
+        if listeners is None:
+            self.attach(*self.transport.connect())
+            return
+        # connections are accepted from the glib main loop
+        self.scontrol, self.sinterrupt = listeners
+        GLib.io_add_watch(self.scontrol.fileno(), GLib.IO_IN, self.on_control_conn)
+        GLib.io_add_watch(self.sinterrupt.fileno(), GLib.IO_IN, self.on_interrupt_conn)
+
+    # take already connected channels
+    def attach(self, control, interrupt):
+        self.ccontrol = control
+        self.cinterrupt = interrupt
+        for conn in (control, interrupt):
+            self.watches[conn.fileno()] = GLib.io_add_watch(
+                conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_channel)
+
+    def connected(self):
+        return self.cinterrupt is not None
+
+    def on_control_conn(self, fd, condition):
+        conn, cinfo = self.scontrol.accept()
+        if self.ccontrol is not None:
+            # the host reconnected before we saw the old link drop
+            self.disconnect()
+        self.ccontrol = conn
+        self.watches[conn.fileno()] = GLib.io_add_watch(
+            conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_channel)
         print (
-            "\033[0;32mGot a connection on the control channel from %s \033[0m" % cinfo[0])
+            "\033[0;32mGot a connection on the control channel from %s \033[0m" % peer_name(cinfo))
+        return True
 
-        self.cinterrupt, cinfo = self.sinterrupt.accept()
+    def on_interrupt_conn(self, fd, condition):
+        conn, cinfo = self.sinterrupt.accept()
+        if self.cinterrupt is not None:
+            GLib.source_remove(self.watches.pop(self.cinterrupt.fileno()))
+            self.cinterrupt.close()
+        self.cinterrupt = conn
+        self.watches[conn.fileno()] = GLib.io_add_watch(
+            conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_channel)
         print (
-            "\033[0;32mGot a connection on the interrupt channel from %s \033[0m" % cinfo[0])
+            "\033[0;32mGot a connection on the interrupt channel from %s \033[0m" % peer_name(cinfo))
+        # send what was queued now, before any new report gets through
+        if self.pending:
+            self.flush_pending()
+        return True
+
+    # the host only sends handshake/output data we ignore, but an empty read
+    # or a hangup on either channel means the link is gone
+    def on_channel(self, fd, condition):
+        data = b''
+        if condition & GLib.IO_IN:
+            try:
+                data = os.read(fd, 64)
+            except OSError:
+                data = b''
+        if data:
+            if DEBUG:
+                debug('host sent %s', data.hex())
+            return True
+        info('host disconnected')
+        # returning False removes this watch, disconnect removes the rest
+        del self.watches[fd]
+        self.disconnect()
+        return False
 
-    # send a string to the bluetooth host machine
+    def disconnect(self):
+        for watch in self.watches.values():
+            GLib.source_remove(watch)
+        self.watches = {}
+        for conn in (self.ccontrol, self.cinterrupt):
+            if conn is not None:
+                conn.close()
+        self.ccontrol = None
+        self.cinterrupt = None
+
+    # send a report to the bluetooth host machine. message can be any
+    # buffer (bytes, a bytearray from self.reports, a memoryview) and is
+    # sent as is, only queueing it keeps a copy
     def send_string(self, message):
+        t0 = self.last_send = time.monotonic()
+        # while queued reports are waiting, new ones go behind them
+        if self.cinterrupt is None or self.pending:
+            self.queue(message)
+            return
         try:
-            print('--------------')
-            print(bytes(message))
-            self.cinterrupt.send(bytes(message))
+            if DEBUG:
+                debug('interrupt %s', message.hex())
+            self.cinterrupt.send(message)
+            self.send_time.since(t0)
         except OSError as err:
-            print('error in send_string')
-            error(err)
-            self.cinterrupt.close()
-            self.ccontrol.close()
-            self.accept_conn()
+            error('error in send_string: %s', err)
+            self.disconnect()
+            self.queue(message)
+
+    # hold a report until the host reconnects
+    def queue(self, message):
+        if self.pending is None:
+            raise NotConnectedError("host is not connected")
+        item = (time.monotonic(), bytes(message))
+        self.pending.append(item)
+        if message[1] in BTKbDevice.STATE_REPORT_IDS:
+            self.last_state[message[1]] = item
+
+    # collapse the queued reports into what the host still needs to see:
+    # stale reports are dropped, repeated states are sent once, and the
+    # last report of each id (e.g. the final key release) is always kept
+    def coalesce(self, pending, now):
+        last = {}
+        for i, (t, report) in enumerate(pending):
+            last[report[1]] = i
+        reports = []
+        sent = {}
+        for i, (t, report) in enumerate(pending):
+            report_id = report[1]
+            if now - t > BTKbDevice.QUEUE_MAX_AGE and last[report_id] != i:
+                continue
+            if report_id in BTKbDevice.STATE_REPORT_IDS and sent.get(report_id) == report:
+                continue
+            sent[report_id] = report
+            reports.append(report)
+        return reports
+
+    def flush_pending(self):
+        if not self.pending or self.cinterrupt is None:
+            return False
+        pending = list(self.pending)
+        self.pending.clear()
+        # final states the ring dropped are older than everything left in
+        # it, and nothing of their id is left, so they go first
+        evicted = sorted(item for item in self.last_state.values()
+                         if not any(p is item for p in pending))
+        self.last_state.clear()
+        pending = evicted + pending
+        now = time.monotonic()
+        for t, report in pending:
+            self.queue_time.add(now - t, now)
+        reports = self.coalesce(pending, now)
+        info('sending %d of %d reports queued while disconnected',
+             len(reports), len(pending))
+        for report in reports:
+            self.send_string(report)
+        return False
 
     def send_control_string(self, message):
+        if self.ccontrol is None:
+            raise NotConnectedError("host is not connected")
         try:
-            print('--------------')
-            print(bytes(message))
+            if DEBUG:
+                debug('control %s', bytes(message).hex())
             self.ccontrol.send(bytes(message))
         except OSError as err:
-            print('error in send_control_string')
-            error(err)
-            self.cinterrupt.close()
-            self.ccontrol.close()
-            self.accept_conn()
+            error('error in send_control_string: %s', err)
+            self.disconnect()
+            raise NotConnectedError(str(err))
+
+
+# Collects relative mouse motion and sends at most one report per INTERVAL
+# ms, so a 1000 Hz mouse does not saturate the link. Button changes are sent
+# right away, and motion is never dropped: what does not fit in one report
+# is carried over to the next.
+class MouseCoalescer():
+    # ms between motion reports, 0 sends every event as it comes
+    INTERVAL = 8
+
+    def __init__(self, device, interval=None):
+        self.device = device
+        self.interval = MouseCoalescer.INTERVAL if interval is None else interval
+        self.buf = device.reports[hid.MOUSE_REPORT_ID]
+        self.buttons = 0
+        self.dx = self.dy = self.wheel = 0
+        self.last_sent = 0.0
+        self.timer = None
+
+    def motion(self, buttons, dx, dy, wheel):
+        if buttons != self.buttons:
+            # motion so far goes out with the old buttons, then the change
+            if self.dx or self.dy or self.wheel:
+                self.flush()
+            self.buttons = buttons
+            self.dx += dx
+            self.dy += dy
+            self.wheel += wheel
+            self.flush()
+            return
+        self.dx += dx
+        self.dy += dy
+        self.wheel += wheel
+        if self.timer is not None:
+            return
+        wait = self.interval - (time.monotonic() - self.last_sent) * 1000
+        if wait <= 0:
+            self.flush()
+        else:
+            self.timer = GLib.timeout_add(int(wait) + 1, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        try:
+            self.flush()
+        except NotConnectedError:
+            # the host went away (and nothing is queued), drop the motion
+            self.dx = self.dy = self.wheel = 0
+            if self.timer is not None:
+                GLib.source_remove(self.timer)
+                self.timer = None
+        return False
+
+    @staticmethod
+    def clamp(v):
+        return -127 if v < -127 else 127 if v > 127 else v
+
+    # send one report with the buttons and as much motion as fits, the rest
+    # goes out from a timer
+    def flush(self):
+        # this report carries the motion a pending timer was waiting for
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        x = self.clamp(self.dx)
+        y = self.clamp(self.dy)
+        w = self.clamp(self.wheel)
+        self.dx -= x
+        self.dy -= y
+        self.wheel -= w
+        buf = self.buf
+        buf[2] = self.buttons
+        buf[3] = x & 0xFF
+        buf[4] = y & 0xFF
+        buf[5] = w & 0xFF
+        self.last_sent = time.monotonic()
+        self.device.send_string(buf)
+        if (self.dx or self.dy or self.wheel) and self.timer is None:
+            self.timer = GLib.timeout_add(max(self.interval, 1), self.on_timer)
+
+
+# Repeats a held key without a round trip through kb_client for every
+# repeat: after DELAY ms, and then every INTERVAL ms, the key's up and down
+# reports are sent again. Any other report with the same id from a client
+# stops the repeat, like a real keyboard only repeats the last key pressed,
+# except a keyboard report that only changes the modifiers: the key keeps
+# repeating with the new modifiers.
+# The key is down on the host in between, so the host's own autorepeat has
+# to be turned off or it repeats the key as well.
+class KeyRepeater():
+    DELAY = 500
+    INTERVAL = 33
+
+    def __init__(self, device):
+        self.device = device
+        # report id -> last report a client sent with it
+        self.last = {}
+        self.down = None
+        self.up = None
+        self.interval = KeyRepeater.INTERVAL
+        self.timer = None
+
+    # note a report from a client, called before it is sent
+    def seen(self, report):
+        report_id = report[1]
+        if self.down is not None and self.down[1] == report_id:
+            if report_id == hid.KEYBOARD_REPORT_ID and self.down[3:] == report[3:]:
+                self.down[2] = report[2]
+                self.up[2] = report[2]
+            else:
+                self.stop()
+        last = self.last.get(report_id)
+        if last is None:
+            self.last[report_id] = bytearray(report)
+        else:
+            last[:] = report
+
+    # start repeating, down has to be the last report sent with its id or
+    # the key was released already (e.g. the release came in over the report
+    # socket before this call came in over dbus)
+    def start(self, down, up, delay, interval):
+        self.stop()
+        if self.last.get(down[1]) != down:
+            return False
+        self.down = bytearray(down)
+        self.up = bytearray(up)
+        self.interval = interval or KeyRepeater.INTERVAL
+        self.timer = GLib.timeout_add(delay or KeyRepeater.DELAY, self.on_timer)
+        return True
+
+    def on_timer(self):
+        self.timer = None
+        if not self.device.connected() or self.device.pending:
+            # don't fill the queue with repeats or jump ahead of it
+            self.stop()
+            return False
+        try:
+            self.device.send_string(self.up)
+            self.device.send_string(self.down)
+        except NotConnectedError:
+            self.stop()
+            return False
+        self.timer = GLib.timeout_add(self.interval, self.on_timer)
+        return False
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.down = None
+        self.up = None
+
+
+# local socket kb_client can write whole reports to, skipping the dbus hop
+REPORT_SOCKET = "/run/fruit2pi/report.sock"
 
 
 class BTKbService(dbus.service.Object):
-    def __init__(self):
+    def __init__(self, report_socket=REPORT_SOCKET, queue_size=BTKbDevice.QUEUE_SIZE,
+                 transport=None):
         print("1. Setting up service")
         # set up as a dbus service
         bus_name = dbus.service.BusName(
             "org.fruit2pi.btkbservice", bus=dbus.SystemBus())
         dbus.service.Object.__init__(
             self, bus_name, "/org/fruit2pi/btkbservice")
+        self.keyboard_mode = BTKbDevice.KEYBOARD_MODE
         # create and setup our device
-        self.device = BTKbDevice()
+        self.device = BTKbDevice(queue_size, transport)
+        # only the reports in the sdp record's descriptor are sent
+        self.report_lengths = self.device.report_lengths
+        # clears the nkro bitmap (and reserved byte) without allocating
+        self.nkro_zero = bytes(self.report_lengths[hid.KEYBOARD_REPORT_ID] - 1)
         # start listening for connections
         self.device.listen()
+        self.mouse = None
+        if hid.MOUSE_REPORT_ID in self.report_lengths:
+            self.mouse = MouseCoalescer(self.device)
+        # the latest histograms kb_client sent with put_stats
+        self.client_stats = {}
+        self.repeater = KeyRepeater(self.device)
+        self.report_conns = {}
+        # datagrams from report socket clients are read into this
+        self.report_buf = bytearray(64)
+        self.report_view = memoryview(self.report_buf)
+        # (report, delay in ms after it) left to send from send_reports
+        self.macro = deque()
+        self.macro_timer = None
+        if report_socket:
+            self.listen_reports(report_socket)
 
-    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='yay')
+    # accept local clients sending reports as SEQPACKET datagrams, each
+    # datagram is one complete report starting with 0xA1
+    def listen_reports(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        self.sreport = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sreport.bind(path)
+        os.chmod(path, 0o660)
+        self.sreport.listen(5)
+        GLib.io_add_watch(self.sreport.fileno(), GLib.PRIORITY_HIGH,
+                          GLib.IO_IN, self.on_report_conn)
+        print("Listening for reports on " + path)
+
+    def on_report_conn(self, fd, condition):
+        conn, _ = self.sreport.accept()
+        self.report_conns[conn.fileno()] = conn
+        GLib.io_add_watch(conn.fileno(), GLib.PRIORITY_HIGH,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_report)
+        return True
+
+    def on_report(self, fd, condition):
+        conn = self.report_conns[fd]
+        n = 0
+        if condition & GLib.IO_IN:
+            try:
+                n = conn.recv_into(self.report_buf)
+            except OSError:
+                n = 0
+        if not n:
+            del self.report_conns[fd]
+            conn.close()
+            return False
+        data = self.report_view[:n]
+        try:
+            self.check_report(data)
+            if data[1] == hid.MOUSE_REPORT_ID:
+                self.mouse.motion(data[2], signed_byte(data[3]),
+                                  signed_byte(data[4]), signed_byte(data[5]))
+            else:
+                self.send(data)
+        except (ValueError, UnsupportedReportError) as e:
+            warning('dropped report from local client: %s', e)
+        except NotConnectedError:
+            pass
+        return True
+
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='yay',
+                         byte_arrays=True)
     def send_key(self, modifier_byte, keys):
-        global current_program
-        print("Get on_receive_keys request through dbus")
-        print("key msg: ", keys)
-        state = [ 0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0 ]
-        state[2] = int(modifier_byte)
-        count = 4
-        for key_code in keys:
-            if(count < 10):
-                state[count] = int(key_code)
-            count += 1
-        self.device.send_string(state)
+        state = self.device.reports[hid.KEYBOARD_REPORT_ID]
+        state[2] = modifier_byte
+        if self.keyboard_mode == 'nkro':
+            # any number of keys, one bit each after modifier and reserved byte
+            state[3:] = self.nkro_zero
+            for key_code in keys:
+                if 0 < key_code < hid.NKRO_USAGES:
+                    state[4 + (key_code >> 3)] |= 1 << (key_code & 7)
+            self.send(state)
+            return
+        n = len(keys)
+        for i in range(6):
+            state[4 + i] = keys[i] if i < n else 0
+        self.send(state)
+
+    # send the consumer control usage that is down, 0 for none
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='q')
+    def send_consumer(self, usage):
+        usage = int(usage)
+        if usage > hid.CONSUMER_USAGE_MAX:
+            raise ValueError("consumer usage 0x%x out of range" % usage)
+        self.require(hid.CONSUMER_REPORT_ID)
+        state = self.device.reports[hid.CONSUMER_REPORT_ID]
+        state[2] = usage & 0xFF
+        state[3] = usage >> 8
+        self.send(state)
+
+    # send the system control key that is down: 1 power down, 2 sleep,
+    # 3 wake up, 0 for none
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='y')
+    def send_system(self, value):
+        value = int(value)
+        if value > 3:
+            raise ValueError("system control value %d out of range" % value)
+        self.require(hid.SYSTEM_REPORT_ID)
+        state = self.device.reports[hid.SYSTEM_REPORT_ID]
+        state[2] = value
+        self.send(state)
 
+    # send one complete report (0xA1, report id, payload) as the client
+    # built it, e.g. kb_client's NKRO bitmap report
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='ay',
+                         byte_arrays=True)
+    def send_report(self, report):
+        self.check_report(report)
+        self.send(report)
+
+    # a key, consumer or system report from a client
+    def send(self, report):
+        self.repeater.seen(report)
+        self.device.send_string(report)
+
+    # repeat a held key: after delay ms, then every interval ms, send up
+    # and down again until another report with the same id comes in. 0 uses
+    # the --repeat-delay/--repeat-interval defaults. Returns False if down
+    # is no longer the current report, i.e. the key was released already.
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='ayayuu',
+                         out_signature='b', byte_arrays=True)
+    def repeat_report(self, down, up, delay, interval):
+        self.check_report(down)
+        self.check_report(up)
+        if down[1] != up[1] or down[1] == hid.MOUSE_REPORT_ID:
+            raise ValueError("down and up have to be key reports with the same id")
+        return self.repeater.start(down, up, int(delay), int(interval))
+
+    # stop repeating, for a release the client did not send a report for
+    @dbus.service.method('org.fruit2pi.btkbservice')
+    def stop_repeat(self):
+        self.repeater.stop()
+
+    # the keyboard report family in use, '6kro' or 'nkro'
+    @dbus.service.method('org.fruit2pi.btkbservice', out_signature='s')
+    def get_keyboard_mode(self):
+        return self.keyboard_mode
+
+    # the host only knows the reports in the sdp record's descriptor
+    def require(self, report_id):
+        if report_id not in self.report_lengths:
+            raise UnsupportedReportError("report %d is not in the HID descriptor" % report_id)
+
+    def check_report(self, report):
+        if len(report) < 3 or report[0] != 0xA1:
+            raise ValueError("not an input report")
+        self.require(report[1])
+        length = self.report_lengths[report[1]]
+        if len(report) != 2 + length:
+            raise ValueError("report %d should be %d bytes, got %d"
+                             % (report[1], length, len(report) - 2))
+
+    # keys are buttons, x, y and wheel as in the mouse report, the
+    # modifier byte is unused
     @dbus.service.method('org.fruit2pi.btkbservice', in_signature='yay')
     def send_mouse(self, modifier_byte, keys):
-        state = [0xA1, 2, 0, 0, 0, 0]
-        count = 2
+        self.require(hid.MOUSE_REPORT_ID)
+        state = [0, 0, 0, 0]
+        count = 0
         for key_code in keys:
-            if(count < 6):
+            if(count < 4):
                 state[count] = int(key_code)
             count += 1
-        self.device.send_string(state)
+        self.mouse.motion(state[0], signed_byte(state[1]),
+                          signed_byte(state[2]), signed_byte(state[3]))
+
+    # relative motion with 16 bit deltas, coalesced with other motion
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='ynnn')
+    def send_mouse_motion(self, buttons, dx, dy, wheel):
+        self.require(hid.MOUSE_REPORT_ID)
+        self.mouse.motion(int(buttons), int(dx), int(dy), int(wheel))
+
+    # send a batch of complete reports (starting with 0xA1). delays are in
+    # ms after each report: none, one value for all reports, or one each.
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='aayau',
+                         byte_arrays=True)
+    def send_reports(self, reports, delays):
+        for i, report in enumerate(reports):
+            try:
+                self.check_report(report)
+            except ValueError as e:
+                raise ValueError("report %d: %s" % (i, e))
+        n = len(delays)
+        for i, report in enumerate(reports):
+            if n == 1:
+                delay = delays[0]
+            else:
+                delay = delays[i] if i < n else 0
+            self.macro.append((report, int(delay)))
+        # a batch already being streamed sends these after it
+        if self.macro_timer is None:
+            self.flush_macro()
+
+    # send queued reports until one asks for a delay, then continue from a
+    # glib timeout so the main loop keeps running
+    def flush_macro(self):
+        while self.macro:
+            report, delay = self.macro.popleft()
+            try:
+                self.send(report)
+            except NotConnectedError:
+                # the host is gone, drop the rest of the batch
+                self.macro.clear()
+                break
+            if delay:
+                self.macro_timer = GLib.timeout_add(delay, self.flush_macro)
+                return False
+        self.macro_timer = None
+        return False
+
+    # latency histograms of kb_client and btk_server: stage name -> count
+    # per bucket, see stats.py
+    @dbus.service.method('org.fruit2pi.btkbservice', out_signature='a{sau}')
+    def get_stats(self):
+        stats = dict(self.client_stats)
+        stats.update(self.device.stats.snapshot())
+        return stats
+
+    # kb_client sends its histograms every few seconds
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='a{sau}')
+    def put_stats(self, stats):
+        self.client_stats = dict((str(name), [int(n) for n in counts])
+                                 for name, counts in stats.items())
+
+    # collect garbage from the main loop with the cyclic gc disabled
+    def start_gc(self, collector):
+        self.collector = collector
+        self.on_gc()
+
+    def on_gc(self):
+        wait = self.collector.poll(self.device.last_send)
+        GLib.timeout_add(int(wait * 1000) + 1, self.on_gc)
+        return False
+
+    # change the log level at runtime, e.g. "DEBUG" to see every report
+    @dbus.service.method('org.fruit2pi.btkbservice', in_signature='s')
+    def set_log_level(self, level):
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError("unknown log level " + level)
+        set_log_level(value)
+        info("log level set to %s", level.upper())
 
 
 # main routine
@@ -173,8 +764,50 @@ if __name__ == "__main__":
         if not os.geteuid() == 0:
             sys.exit("Only root can run this script")
 
+        parser = OptionParser(option_list=[
+            make_option("-r", "--report-socket", dest="report_socket",
+                        default=REPORT_SOCKET,
+                        help="unix socket for direct reports, empty to disable"),
+            make_option("-q", "--queue-size", dest="queue_size", type="int",
+                        default=BTKbDevice.QUEUE_SIZE,
+                        help="reports held while the host is disconnected, 0 to drop them"),
+            make_option("-t", "--transport", dest="transport", default="l2cap",
+                        help="l2cap, unix:<path> (host connects to <path>.ctrl "
+                             "and <path>.intr)"),
+            make_option("-s", "--sdp-record", dest="sdp_record", default=None,
+                        help="load the sdp record from this file"),
+            make_option("-k", "--keyboard", dest="keyboard", default="6kro",
+                        type="choice", choices=list(hid.KEYBOARD_MODES),
+                        help="keyboard report: 6kro (boot style) or nkro (bitmap)"),
+            make_option("-m", "--mouse-interval", dest="mouse_interval", type="int",
+                        default=MouseCoalescer.INTERVAL,
+                        help="ms between coalesced mouse motion reports, 0 for none"),
+            make_option("--repeat-delay", dest="repeat_delay", type="int",
+                        default=KeyRepeater.DELAY,
+                        help="default ms before a key repeated with repeat_report repeats "
+                             "(turn off the host's autorepeat when using this)"),
+            make_option("--repeat-interval", dest="repeat_interval", type="int",
+                        default=KeyRepeater.INTERVAL,
+                        help="default ms between repeats"),
+            make_option("-v", "--debug", dest="debug", action="store_true",
+                        default=False, help="log every report"),
+        ] + realtime.OPTIONS)
+        (options, args) = parser.parse_args()
+        if options.debug:
+            set_log_level(logging.DEBUG)
+        BTKbDevice.SDP_RECORD_PATH = options.sdp_record
+        BTKbDevice.KEYBOARD_MODE = options.keyboard
+        MouseCoalescer.INTERVAL = options.mouse_interval
+        KeyRepeater.DELAY = options.repeat_delay
+        KeyRepeater.INTERVAL = options.repeat_interval
+
         DBusGMainLoop(set_as_default=True)
-        myservice = BTKbService()
+        transport = make_transport(options.transport,
+                                   BTKbDevice.P_CTRL, BTKbDevice.P_INTR)
+        myservice = BTKbService(options.report_socket, options.queue_size, transport)
+        collector = realtime.apply(options)
+        if collector:
+            myservice.start_gc(collector)
         loop = GLib.MainLoop()
         loop.run()
     except KeyboardInterrupt:
@@ -0,0 +1,400 @@
+#
+# fruit2pi HID report descriptor and SDP service record
+# The descriptor is built from the item lists below, checked against the
+# report layouts btk_server sends, and rendered into the SDP record once.
+#
+
+from xml.etree import ElementTree
+
+# item tags (HID 1.11, 6.2.2), the low two bits hold the data size
+INPUT = 0x80
+OUTPUT = 0x90
+COLLECTION = 0xA0
+END_COLLECTION = 0xC0
+USAGE_PAGE = 0x04
+LOGICAL_MINIMUM = 0x14
+LOGICAL_MAXIMUM = 0x24
+REPORT_SIZE = 0x74
+REPORT_ID = 0x84
+REPORT_COUNT = 0x94
+USAGE = 0x08
+USAGE_MINIMUM = 0x18
+USAGE_MAXIMUM = 0x28
+
+# logical min/max are signed, everything else unsigned
+SIGNED_TAGS = (LOGICAL_MINIMUM, LOGICAL_MAXIMUM)
+
+APPLICATION = 0x01
+PHYSICAL = 0x00
+DATA_ARRAY_ABS = 0x00
+DATA_VAR_ABS = 0x02
+CONST_ARRAY_ABS = 0x01
+CONST_VAR_ABS = 0x03
+DATA_VAR_REL = 0x06
+
+KEYBOARD_REPORT_ID = 1
+MOUSE_REPORT_ID = 2
+CONSUMER_REPORT_ID = 3
+SYSTEM_REPORT_ID = 4
+
+KEYBOARD = [
+    (USAGE_PAGE, 0x01),  # Generic Desktop
+    (USAGE, 0x06),  # Keyboard
+    (COLLECTION, APPLICATION),
+    (REPORT_ID, KEYBOARD_REPORT_ID),
+    # modifier byte
+    (REPORT_SIZE, 1),
+    (REPORT_COUNT, 8),
+    (USAGE_PAGE, 0x07),  # Key Codes
+    (USAGE_MINIMUM, 0xE0),
+    (USAGE_MAXIMUM, 0xE7),
+    (LOGICAL_MINIMUM, 0),
+    (LOGICAL_MAXIMUM, 1),
+    (INPUT, DATA_VAR_ABS),
+    # reserved byte
+    (REPORT_COUNT, 1),
+    (REPORT_SIZE, 8),
+    (INPUT, CONST_VAR_ABS),
+    # LEDs
+    (REPORT_COUNT, 5),
+    (REPORT_SIZE, 1),
+    (USAGE_PAGE, 0x08),  # LEDs
+    (USAGE_MINIMUM, 1),
+    (USAGE_MAXIMUM, 5),
+    (OUTPUT, DATA_VAR_ABS),
+    (REPORT_COUNT, 1),
+    (REPORT_SIZE, 3),
+    (OUTPUT, CONST_VAR_ABS),
+    # 6 key slots
+    (REPORT_COUNT, 6),
+    (REPORT_SIZE, 8),
+    (LOGICAL_MINIMUM, 0),
+    (LOGICAL_MAXIMUM, 255),
+    (USAGE_PAGE, 0x07),  # Key Codes
+    (USAGE_MINIMUM, 0),
+    (USAGE_MAXIMUM, 255),
+    (INPUT, DATA_ARRAY_ABS),
+    (END_COLLECTION, None),
+]
+
+# n key rollover: modifiers, reserved byte, LEDs and one bit per key usage.
+# The bitmap covers the whole usage byte like the 6kro slots do, so keys
+# above the modifiers (0xE8 on, e.g. find or scroll up) are not lost; the
+# modifier bits 0xE0-0xE7 in it are never set, the modifier byte has them.
+NKRO_USAGES = 0x100
+
+KEYBOARD_NKRO = KEYBOARD[:KEYBOARD.index((REPORT_COUNT, 6))] + [
+    (REPORT_COUNT, NKRO_USAGES),
+    (REPORT_SIZE, 1),
+    (LOGICAL_MINIMUM, 0),
+    (LOGICAL_MAXIMUM, 1),
+    (USAGE_PAGE, 0x07),  # Key Codes
+    (USAGE_MINIMUM, 0),
+    (USAGE_MAXIMUM, NKRO_USAGES - 1),
+    (INPUT, DATA_VAR_ABS),
+    (END_COLLECTION, None),
+]
+
+MOUSE = [
+    (USAGE_PAGE, 0x01),  # Generic Desktop
+    (USAGE, 0x02),  # Mouse
+    (COLLECTION, APPLICATION),
+    (REPORT_ID, MOUSE_REPORT_ID),
+    (USAGE, 0x01),  # Pointer
+    (COLLECTION, PHYSICAL),
+    # 5 buttons and padding
+    (REPORT_COUNT, 5),
+    (REPORT_SIZE, 1),
+    (USAGE_PAGE, 0x09),  # Buttons
+    (USAGE_MINIMUM, 1),
+    (USAGE_MAXIMUM, 5),
+    (LOGICAL_MINIMUM, 0),
+    (LOGICAL_MAXIMUM, 1),
+    (INPUT, DATA_VAR_ABS),
+    (REPORT_COUNT, 1),
+    (REPORT_SIZE, 3),
+    (INPUT, CONST_ARRAY_ABS),
+    # x, y, wheel
+    (REPORT_SIZE, 8),
+    (REPORT_COUNT, 3),
+    (USAGE_PAGE, 0x01),  # Generic Desktop
+    (USAGE, 0x30),  # X
+    (USAGE, 0x31),  # Y
+    (USAGE, 0x38),  # Wheel
+    (LOGICAL_MINIMUM, -127),
+    (LOGICAL_MAXIMUM, 127),
+    (INPUT, DATA_VAR_REL),
+    (END_COLLECTION, None),
+    (END_COLLECTION, None),
+]
+
+# one 16 bit consumer control usage (volume, media keys, browser keys)
+CONSUMER_USAGE_MAX = 0x3FF
+
+CONSUMER = [
+    (USAGE_PAGE, 0x0C),  # Consumer
+    (USAGE, 0x01),  # Consumer Control
+    (COLLECTION, APPLICATION),
+    (REPORT_ID, CONSUMER_REPORT_ID),
+    (REPORT_COUNT, 1),
+    (REPORT_SIZE, 16),
+    (LOGICAL_MINIMUM, 0),
+    (LOGICAL_MAXIMUM, CONSUMER_USAGE_MAX),
+    (USAGE_MINIMUM, 0),
+    (USAGE_MAXIMUM, CONSUMER_USAGE_MAX),
+    (INPUT, DATA_ARRAY_ABS),
+    (END_COLLECTION, None),
+]
+
+# power down, sleep, wake up as 1 to 3, then padding
+SYSTEM = [
+    (USAGE_PAGE, 0x01),  # Generic Desktop
+    (USAGE, 0x80),  # System Control
+    (COLLECTION, APPLICATION),
+    (REPORT_ID, SYSTEM_REPORT_ID),
+    (REPORT_COUNT, 1),
+    (REPORT_SIZE, 2),
+    (LOGICAL_MINIMUM, 1),
+    (LOGICAL_MAXIMUM, 3),
+    (USAGE_MINIMUM, 0x81),  # System Power Down
+    (USAGE_MAXIMUM, 0x83),  # System Wake Up
+    (INPUT, DATA_ARRAY_ABS),
+    (REPORT_SIZE, 6),
+    (INPUT, CONST_VAR_ABS),
+    (END_COLLECTION, None),
+]
+
+# keyboard report families, the item lists and the keyboard report payload
+# size in bytes (without the 0xA1 header and report id)
+KEYBOARD_MODES = {
+    '6kro': (KEYBOARD, 8),
+    'nkro': (KEYBOARD_NKRO, 2 + NKRO_USAGES // 8),
+}
+
+
+# input report payload sizes that BTKbService.send_key/send_mouse/
+# send_consumer/send_system build
+def report_lengths(mode='6kro'):
+    return {
+        KEYBOARD_REPORT_ID: KEYBOARD_MODES[mode][1],
+        MOUSE_REPORT_ID: 4,
+        CONSUMER_REPORT_ID: 2,
+        SYSTEM_REPORT_ID: 1,
+    }
+
+
+def encode_item(tag, value):
+    if value is None:
+        return bytes([tag])
+    signed = tag in SIGNED_TAGS
+    for size, code in ((1, 1), (2, 2), (4, 3)):
+        try:
+            data = value.to_bytes(size, 'little', signed=signed)
+        except OverflowError:
+            continue
+        return bytes([tag | code]) + data
+    raise ValueError("item value %r does not fit" % value)
+
+
+def encode(items):
+    return b''.join(encode_item(tag, value) for tag, value in items)
+
+
+# walk a descriptor and return {report id: input payload bytes}
+def input_report_lengths(descriptor):
+    bits = {}
+    report_id = 0
+    size = count = 0
+    i = 0
+    while i < len(descriptor):
+        prefix = descriptor[i]
+        n = (0, 1, 2, 4)[prefix & 0x03]
+        value = int.from_bytes(descriptor[i + 1:i + 1 + n], 'little')
+        tag = prefix & 0xFC
+        if tag == REPORT_ID:
+            report_id = value
+        elif tag == REPORT_SIZE:
+            size = value
+        elif tag == REPORT_COUNT:
+            count = value
+        elif tag == INPUT:
+            bits[report_id] = bits.get(report_id, 0) + size * count
+        i += 1 + n
+    lengths = {}
+    for report_id, n in bits.items():
+        if n % 8:
+            raise ValueError("report %d is not a whole number of bytes" % report_id)
+        lengths[report_id] = n // 8
+    return lengths
+
+
+# check the reports a descriptor declares against the ones btk_server
+# sends, and return {report id: payload bytes} of those it declares. Only
+# the keyboard report is required, an older record may lack the others.
+def check_descriptor(descriptor, mode='6kro'):
+    lengths = input_report_lengths(descriptor)
+    if KEYBOARD_REPORT_ID not in lengths:
+        raise ValueError("descriptor has no keyboard report")
+    declared = {}
+    for report_id, length in report_lengths(mode).items():
+        if report_id not in lengths:
+            continue
+        if lengths[report_id] != length:
+            raise ValueError("descriptor report %d is %d bytes, sent reports are %d"
+                             % (report_id, lengths[report_id], length))
+        declared[report_id] = length
+    return declared
+
+
+def report_descriptor(mode='6kro'):
+    return encode(KEYBOARD_MODES[mode][0] + MOUSE + CONSUMER + SYSTEM)
+
+
+SDP_RECORD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" ?>
+
+<record>
+	<attribute id="0x0001">
+		<sequence>
+			<uuid value="0x1124" />
+		</sequence>
+	</attribute>
+	<attribute id="0x0004">
+		<sequence>
+			<sequence>
+				<uuid value="0x0100" />
+				<uint16 value="0x0011" />
+			</sequence>
+			<sequence>
+				<uuid value="0x0011" />
+			</sequence>
+		</sequence>
+	</attribute>
+	<attribute id="0x0005">
+		<sequence>
+			<uuid value="0x1002" />
+		</sequence>
+	</attribute>
+	<attribute id="0x0006">
+		<sequence>
+			<uint16 value="0x656e" />
+			<uint16 value="0x006a" />
+			<uint16 value="0x0100" />
+		</sequence>
+	</attribute>
+	<attribute id="0x0009">
+		<sequence>
+			<sequence>
+				<uuid value="0x1124" />
+				<uint16 value="0x0100" />
+			</sequence>
+		</sequence>
+	</attribute>
+	<attribute id="0x000d">
+		<sequence>
+			<sequence>
+				<sequence>
+					<uuid value="0x0100" />
+					<uint16 value="0x0013" />
+				</sequence>
+				<sequence>
+					<uuid value="0x0011" />
+				</sequence>
+			</sequence>
+		</sequence>
+	</attribute>
+	<attribute id="0x0100">
+		<text value="Raspberry Pi Virtual Keyboard" />
+	</attribute>
+	<attribute id="0x0101">
+		<text value="USB > BT Keyboard" />
+	</attribute>
+	<attribute id="0x0102">
+		<text value="Raspberry Pi" />
+	</attribute>
+	<attribute id="0x0200">
+		<uint16 value="0x0100" />
+	</attribute>
+	<attribute id="0x0201">
+		<uint16 value="0x0111" />
+	</attribute>
+	<attribute id="0x0202">
+		<uint8 value="0xC0" />
+	</attribute>
+	<attribute id="0x0203">
+		<uint8 value="0x00" />
+	</attribute>
+	<attribute id="0x0204">
+		<boolean value="false" />
+	</attribute>
+	<attribute id="0x0205">
+		<boolean value="false" />
+	</attribute>
+	<attribute id="0x0206">
+		<sequence>
+			<sequence>
+				<uint8 value="0x22" />
+				<text encoding="hex" value="{descriptor}" />
+			</sequence>
+		</sequence>
+	</attribute>
+	<attribute id="0x0207">
+		<sequence>
+			<sequence>
+				<uint16 value="0x0409" />
+				<uint16 value="0x0100" />
+			</sequence>
+		</sequence>
+	</attribute>
+	<attribute id="0x020b">
+		<uint16 value="0x0100" />
+	</attribute>
+	<attribute id="0x020c">
+		<uint16 value="0x0c80" />
+	</attribute>
+	<attribute id="0x020d">
+		<boolean value="false" />
+	</attribute>
+	<attribute id="0x020e">
+		<boolean value="false" />
+	</attribute>
+	<attribute id="0x020f">
+		<uint16 value="0x0640" />
+	</attribute>
+	<attribute id="0x0210">
+		<uint16 value="0x0320" />
+	</attribute>
+</record>
+"""
+
+
+# pull the hex report descriptor (attribute 0x0206) out of an sdp record
+def record_descriptor(record):
+    root = ElementTree.fromstring(record.encode('utf-8'))
+    for attr in root.iter('attribute'):
+        if attr.get('id', '').lower() == '0x0206':
+            for text in attr.iter('text'):
+                return bytes.fromhex(text.get('value'))
+    raise ValueError("sdp record has no HID descriptor list")
+
+
+_records = {}
+
+# return the sdp record and the report lengths its descriptor declares
+# (see check_descriptor), rendered from the descriptor for mode or read from
+# path, validated on first use and cached after that
+def load_sdp_record(path=None, mode='6kro'):
+    loaded = _records.get((path, mode))
+    if loaded is not None:
+        return loaded
+    if path:
+        with open(path) as f:
+            record = f.read()
+    else:
+        record = SDP_RECORD_TEMPLATE.replace('{descriptor}', report_descriptor(mode).hex())
+    loaded = (record, check_descriptor(record_descriptor(record), mode))
+    _records[(path, mode)] = loaded
+    return loaded
+
+
+def sdp_record(path=None, mode='6kro'):
+    return load_sdp_record(path, mode)[0]
@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+#
+# fruit2pi latency dump
+# Prints the per stage latency histograms btk_server and kb_client keep,
+# as returned by btk_server's get_stats dbus method. Times are bucket upper
+# bounds, so "64" means under 64 us.
+#
+import sys
+import dbus
+from optparse import OptionParser, make_option
+from stats import percentile
+
+
+def get_stats():
+    bus = dbus.SystemBus()
+    service = bus.get_object('org.fruit2pi.btkbservice', '/org/fruit2pi/btkbservice')
+    iface = dbus.Interface(service, 'org.fruit2pi.btkbservice')
+    return dict((str(name), [int(n) for n in counts])
+                for name, counts in iface.get_stats().items())
+
+
+def fmt(us):
+    return "-" if us is None else "%d" % us
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="latency.py [options] [stage ...]", option_list=[
+        make_option("-b", "--buckets", dest="buckets", action="store_true",
+                    default=False, help="print the bucket counts too"),
+    ])
+    (options, args) = parser.parse_args()
+    try:
+        stats = get_stats()
+    except dbus.DBusException as e:
+        sys.exit("could not get stats from btk_server: %s" % e)
+
+    print("%-16s %8s %8s %8s %8s %8s" % ("stage", "count", "p50 us", "p90 us", "p99 us", "max us"))
+    for name in sorted(stats):
+        if args and name not in args:
+            continue
+        counts = stats[name]
+        print("%-16s %8d %8s %8s %8s %8s" %
+              (name, sum(counts), fmt(percentile(counts, 0.5)), fmt(percentile(counts, 0.9)),
+               fmt(percentile(counts, 0.99)), fmt(percentile(counts, 1.0))))
+        if options.buckets:
+            print("    " + " ".join("<%d:%d" % (1 << i, n) for i, n in enumerate(counts) if n))
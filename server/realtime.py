@@ -0,0 +1,98 @@
+#
+# fruit2pi real-time options
+# Scheduling, memory locking and garbage collection settings shared by
+# btk_server.py and kb_client.py. The Pi has one core shared with WiFi,
+# journald and everything else, so what hurts is jitter: being scheduled
+# late, paging something back in, or a cyclic gc pass landing on a key.
+#
+
+import ctypes
+import ctypes.util
+import gc
+import os
+import sys
+import time
+from optparse import make_option
+
+# from <sys/mman.h>
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# long options only, the scripts' short options differ
+OPTIONS = [
+    make_option("--rt-priority", dest="rt_priority", type="int", default=0,
+                help="run with SCHED_FIFO at this priority (1-99), 0 to leave it"),
+    make_option("--nice", dest="nice", type="int", default=None,
+                help="nice value to run at when not SCHED_FIFO"),
+    make_option("--cpus", dest="cpus", default=None,
+                help="comma separated cpus to run on"),
+    make_option("--mlock", dest="mlock", action="store_true", default=False,
+                help="lock all memory with mlockall"),
+    make_option("--no-gc", dest="no_gc", action="store_true", default=False,
+                help="disable the cyclic gc, collect only when idle"),
+]
+
+
+def warn(msg):
+    print("realtime: " + msg, file=sys.stderr)
+
+
+def set_scheduling(rt_priority=0, nice=None, cpus=None):
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        if rt_priority:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(rt_priority))
+        elif nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+    except (OSError, ValueError) as e:
+        warn("could not set scheduling: %s" % e)
+
+
+def lock_memory():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        warn("mlockall failed: %s" % os.strerror(ctypes.get_errno()))
+
+
+# Takes over from the cyclic gc. poll() collects once INTERVAL seconds have
+# passed and nothing happened for QUIET seconds, and returns how long until
+# it wants to be polled again.
+class IdleCollector():
+    INTERVAL = 10.0
+    QUIET = 0.5
+
+    def __init__(self):
+        # everything allocated during startup lives forever, keep it out of
+        # the collections
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self.last_collect = time.monotonic()
+
+    # last_activity is the monotonic time of the last report or event
+    def poll(self, last_activity):
+        now = time.monotonic()
+        wait = self.last_collect + IdleCollector.INTERVAL - now
+        if wait > 0:
+            return wait
+        wait = last_activity + IdleCollector.QUIET - now
+        if wait > 0:
+            return wait
+        gc.collect()
+        self.last_collect = time.monotonic()
+        return IdleCollector.INTERVAL
+
+
+# apply the OPTIONS, call once set up and before entering the event loop.
+# Returns the IdleCollector to poll with --no-gc, None otherwise.
+def apply(options):
+    cpus = None
+    if options.cpus:
+        cpus = [int(cpu) for cpu in options.cpus.split(",")]
+    set_scheduling(options.rt_priority, options.nice, cpus)
+    if options.mlock:
+        lock_memory()
+    if options.no_gc:
+        return IdleCollector()
+    return None
@@ -0,0 +1,84 @@
+#
+# fruit2pi latency statistics
+# Rolling histograms of how long each stage of a key report takes, kept by
+# kb_client and btk_server and read with btk_server's get_stats (see
+# latency.py). Recording a sample is a bucket increment in a preallocated
+# array, cheap enough to leave on all the time.
+#
+
+import time
+from array import array
+
+
+# bucket i counts samples of less than 2**i us (bucket 0: under 1 us), the
+# last bucket also takes everything slower
+BUCKETS = 24
+ZERO = array('L', [0] * BUCKETS)
+
+
+class Histogram():
+    # samples are kept for between one and two windows (seconds)
+    WINDOW = 60.0
+
+    def __init__(self):
+        self.current = array('L', ZERO)
+        self.previous = array('L', ZERO)
+        self.started = time.monotonic()
+
+    # move on to the window now falls in: after one window the current
+    # samples become the previous ones, after two or more nothing is left
+    def rotate(self, now):
+        windows = int((now - self.started) // Histogram.WINDOW)
+        if windows <= 0:
+            return
+        if windows == 1:
+            self.previous, self.current = self.current, self.previous
+        else:
+            self.previous[:] = ZERO
+        self.current[:] = ZERO
+        self.started += windows * Histogram.WINDOW
+
+    def add(self, seconds, now):
+        if now - self.started >= Histogram.WINDOW:
+            self.rotate(now)
+        # clock steps can make a sample negative, count it as 0
+        i = int(seconds * 1000000).bit_length() if seconds > 0 else 0
+        self.current[i if i < BUCKETS else BUCKETS - 1] += 1
+
+    # record the time since start (a time.monotonic() value)
+    def since(self, start):
+        now = time.monotonic()
+        self.add(now - start, now)
+
+    def counts(self):
+        self.rotate(time.monotonic())
+        return [a + b for a, b in zip(self.previous, self.current)]
+
+
+# histograms by stage name
+class Stats():
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, name):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    # stage name -> bucket counts
+    def snapshot(self):
+        return dict((name, h.counts()) for name, h in self.histograms.items())
+
+
+# upper bound in us of the bucket the q quantile falls in, None if empty
+def percentile(counts, q):
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= q * total:
+            return 1 << i
+    return 1 << (len(counts) - 1)
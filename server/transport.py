@@ -0,0 +1,80 @@
+#
+# fruit2pi HID transports
+# The control and interrupt channels BTKbDevice talks to the host over.
+# L2CAP is the real bluetooth link, the others let btk_server run at full
+# report rate on machines without a radio.
+#
+
+import os
+import socket
+
+
+class Transport():
+    # whether the bluetooth adapter and bluez profile have to be set up
+    needs_adapter = False
+
+    # return the listening (control, interrupt) sockets, or None if the
+    # transport hands out connected channels instead, from its
+    # connect() returning the device side (control, interrupt) sockets
+    def listen(self):
+        return None
+
+
+class L2capTransport(Transport):
+    needs_adapter = True
+
+    def __init__(self, control_port, interrupt_port):
+        self.ports = (control_port, interrupt_port)
+
+    def listen(self):
+        socks = []
+        for port in self.ports:
+            sock = socket.socket(
+                socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)  # BluetoothSocket(L2CAP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((socket.BDADDR_ANY, port))
+            sock.listen(5)
+            socks.append(sock)
+        return tuple(socks)
+
+
+# a "host" connects to <path>.ctrl and then <path>.intr
+class UnixTransport(Transport):
+    def __init__(self, path):
+        self.paths = (path + ".ctrl", path + ".intr")
+
+    def listen(self):
+        socks = []
+        for path in self.paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sock.bind(path)
+            sock.listen(5)
+            socks.append(sock)
+        return tuple(socks)
+
+
+# already connected socketpairs, the host ends are left in self.host.
+# Only for use in the same process (bench.py), whoever holds the host ends
+# has to read them or sends block once the socket buffer is full.
+class PipeTransport(Transport):
+    def __init__(self):
+        self.host = None
+
+    def connect(self):
+        control, host_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        interrupt, host_interrupt = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.host = (host_control, host_interrupt)
+        return (control, interrupt)
+
+
+# parse a --transport option: l2cap or unix:<path>
+def make_transport(spec, control_port, interrupt_port):
+    kind, _, arg = spec.partition(':')
+    if kind == 'l2cap':
+        return L2capTransport(control_port, interrupt_port)
+    if kind == 'unix':
+        return UnixTransport(arg or "/run/fruit2pi/hid")
+    raise ValueError("unknown transport " + spec)